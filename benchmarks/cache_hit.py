@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+
+"""
+Benchmark for re-running an unchanged `%%pybind11` cell.
+
+Compares the in-memory hit path (the cell has already been run in this session) with the
+on-disk hit path (the module binary is cached but the cell hasn't been run yet, e.g. after
+restarting the kernel). The module is built once before the measurements start.
+
+    python benchmarks/cache_hit.py [-n NUMBER] [-s SYMBOLS]
+"""
+
+import argparse
+import timeit
+
+from IPython.testing.globalipapp import start_ipython
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('-n', '--number', type=int, default=1000,
+                        help='number of cell runs per measurement')
+    parser.add_argument('-s', '--symbols', type=int, default=50,
+                        help='number of symbols exported by the module')
+    args = parser.parse_args()
+
+    ip = start_ipython()
+    ip.run_line_magic('load_ext', 'ipybind')
+    magics = ip.magics_manager.registry['Pybind11Magics']
+    defs = '\n'.join('    m.def("f{0}", []() {{ return {0}; }});'.format(i)
+                     for i in range(args.symbols))
+    cell = 'PYBIND11_MODULE(bench, m) {{\n{}\n}}\n'.format(defs)
+    ip.run_cell_magic('pybind11', '', cell)
+
+    def memory_hit():
+        ip.run_cell_magic('pybind11', '', cell)
+
+    def disk_hit():
+        magics.memo.clear()
+        ip.run_cell_magic('pybind11', '', cell)
+
+    for name, fn in (('in-memory hit', memory_hit), ('on-disk hit', disk_hit)):
+        number = args.number if fn is memory_hit else max(1, args.number // 10)
+        best = min(timeit.repeat(fn, number=number, repeat=5)) / number
+        print('{:<16} {:>10.1f} us per cell'.format(name, best * 1e6))
+
+
+if __name__ == '__main__':
+    main()
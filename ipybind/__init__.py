@@ -1,8 +1,9 @@
 # -*- coding: utf-8 -*-
 
-from ipybind.spawn import patch_spawn
+from ipybind.spawn import patch_spawn, patch_log
 patch_spawn()
-del patch_spawn
+patch_log()
+del patch_spawn, patch_log
 
 __version__ = '0.1.0'
 
@@ -10,6 +11,8 @@ __version__ = '0.1.0'
 def load_ipython_extension(ip):
     from ipybind.magic import Pybind11Magics
     from ipybind.notebook import setup_notebook
+    from ipybind.prewarm import start_prewarm
 
     ip.register_magics(Pybind11Magics)
     setup_notebook()
+    start_prewarm()
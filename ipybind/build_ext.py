@@ -1,21 +1,125 @@
 # -*- coding: utf-8 -*-
 
 import contextlib
+import hashlib
 import os
 import re
+import shutil
 import sys
 import tempfile
+import threading
 
+import distutils.ccompiler
 import distutils.errors
 import distutils.file_util
 import distutils.log
+import distutils.sysconfig
 import setuptools.command.build_ext
 
-from ipybind.common import cache_path
-from ipybind.spawn import spawn_capture
+from ipybind.common import cache_path, compiler_identity, is_osx, override_vars
+from ipybind.diagnostics import summarize
+from ipybind.scheduler import Scheduler
+from ipybind.spawn import Cancellation, spawn_capture
+from ipybind.time_report import (extract_gcc_reports, format_report, parse_clang_trace,
+                                 parse_gcc_report)
+
+# guards os.environ while it's being temporarily overridden to customize the compiler
+_environ_lock = threading.Lock()
+
+# results of compiler flag probes, shared between builds, keyed by the toolchain and flags
+_flag_cache = {}
+_flag_locks = {}
+_flag_cache_lock = threading.Lock()
+
+# alternative linkers, fastest first
+LINKERS = ('mold', 'lld', 'gold')
+
+# precompiled headers being built, keyed by the header hash
+_pch_locks = {}
+_pch_locks_lock = threading.Lock()
+
+# maximum number of precompiled headers kept in the cache (they may take 100+ MB each)
+PCH_LIMIT = 8
+
+
+def pch_deps_changed(gch):
+    """Check if any of the headers a precompiled header was built from has changed since."""
+    try:
+        built = os.path.getmtime(gch)
+        with open(os.path.splitext(gch)[0] + '.d') as f:
+            deps = f.read().replace('\\\n', ' ').partition(': ')[2].split()
+        return not deps or any(os.path.getmtime(dep) > built for dep in deps)
+    except OSError:
+        return True
+
+
+def prune_pch(root, limit=PCH_LIMIT):
+    """Remove least recently used precompiled headers so that at most `limit` are kept."""
+    entries = []
+    for filename in os.listdir(root):
+        if filename.endswith('.gch'):
+            path = os.path.join(root, filename)
+            try:
+                entries.append((os.path.getmtime(path), path))
+            except OSError:
+                pass
+    for _, path in sorted(entries, reverse=True)[limit:]:
+        for filename in (path, os.path.splitext(path)[0] + '.d'):
+            try:
+                os.remove(filename)
+            except OSError:
+                pass
+
+
+def format_size(size):
+    for unit in ('B', 'KB', 'MB'):
+        if size < 1024:
+            break
+        size /= 1024.
+    return '{:.1f} {}'.format(size, unit) if unit != 'B' else '{} B'.format(size)
 
 
 class build_ext(setuptools.command.build_ext.build_ext):
+    user_options = setuptools.command.build_ext.build_ext.user_options + [
+        ('max-jobs=', None,
+         'maximum number of concurrent compiler processes on this host'),
+        ('max-memory=', None,
+         'address space limit for each compiler process (e.g. 2G)'),
+        ('max-cpu-time=', None,
+         'CPU time limit for each compiler process, in seconds'),
+        ('linker=', None,
+         "linker to use: 'auto' (fastest available), 'mold', 'lld', 'gold' or 'default'"),
+        ('remote=', None,
+         'comma-separated list of build workers (HOST:PORT) to offload compilation to'),
+        ('max-errors=', None,
+         'maximum number of compiler errors (and warnings) to show, 0 for no limit'),
+    ]
+
+    env = {}
+    log_name = None
+    scheduler = None
+    cancellation = None
+    time_reports = None
+
+    def initialize_options(self):
+        super().initialize_options()
+        self.max_jobs = None
+        self.max_memory = None
+        self.max_cpu_time = None
+        self.linker = None
+        self.remote = None
+        self.max_errors = None
+
+    def finalize_options(self):
+        super().finalize_options()
+        if self.max_jobs is not None:
+            self.max_jobs = int(self.max_jobs)
+        if self.max_cpu_time is not None:
+            self.max_cpu_time = int(self.max_cpu_time)
+        if self.linker is None:
+            self.linker = os.environ.get('IPYBIND_LINKER') or 'auto'
+        self.max_errors = 10 if self.max_errors is None else int(self.max_errors)
+
     @property
     def is_unix(self):
         return self.compiler.compiler_type == 'unix'
@@ -30,24 +134,47 @@ class build_ext(setuptools.command.build_ext.build_ext):
         self.compiler.verbose = 0
         level = distutils.log.set_threshold(5)
         try:
-            with spawn_capture('never', handler=handler):
+            with spawn_capture('never', handler=handler, env=self.env,
+                               scheduler=self.scheduler):
                 yield
         finally:
             self.compiler.verbose = verbose
             distutils.log.set_threshold(level)
 
-    def has_flag(self, flag):
+    def has_flag(self, flag, link=False):
+        """
+        Check if the compiler accepts the flag(s); if `link` is set, also try linking a
+        shared library with them. The results are cached for the lifetime of the process.
+        """
+        flags = [flag] if isinstance(flag, str) else list(flag)
+        toolchain = [self.compiler.compiler_type]
+        for target in ('compiler_so', 'linker_so') if link else ('compiler_so',):
+            toolchain.extend(getattr(self.compiler, target, None) or [])
+        key = (tuple(toolchain), tuple(sorted(self.env.items())), tuple(flags), link)
+        with _flag_cache_lock:
+            lock = _flag_locks.setdefault(key, threading.Lock())
+        with lock:
+            if key not in _flag_cache:
+                _flag_cache[key] = self.probe_flags(flags, link=link)
+            return _flag_cache[key]
+
+    def probe_flags(self, flags, link=False):
         warnings = []
         # cl.exe may yield return code of 0 if flag is unknown and instead print a warning
-        handler = lambda log: warnings.append("unknown option '{}'".format(flag) in log)
+        handler = lambda log: warnings.append(
+            any("unknown option '{}'".format(flag) in log for flag in flags))
         with tempfile.TemporaryDirectory() as d:
             cpp = os.path.join(d, 'test.cpp')
             with open(cpp, 'w') as f:
                 f.write('int main() { return 0; }')
             try:
                 with self.silence(handler=self.is_msvc and handler or None):
-                    self.compiler.compile([f.name], extra_postargs=[flag], output_dir=d)
-            except distutils.errors.CompileError:
+                    objects = self.compiler.compile([f.name], extra_postargs=flags, output_dir=d)
+                    if link:
+                        self.compiler.link_shared_object(
+                            objects, os.path.join(d, 'test' + self.compiler.shared_lib_extension),
+                            extra_postargs=flags)
+            except (distutils.errors.CompileError, distutils.errors.LinkError):
                 return False
         return not any(warnings)
 
@@ -72,6 +199,78 @@ class build_ext(setuptools.command.build_ext.build_ext):
             return ['-std=c++11']
         sys.exit('Unsupported compiler: at least C++11 support is required')
 
+    def native_flags(self):
+        if self.is_unix:
+            for flag in ('-march=native', '-mcpu=native'):
+                if self.has_flag(flag):
+                    return [flag]
+        distutils.log.warn('warning: compiler does not support tuning for the host CPU')
+        return []
+
+    def time_report_flags(self):
+        if self.is_unix:
+            for flag in ('-ftime-trace', '-ftime-report'):  # clang, gcc
+                if self.has_flag(flag):
+                    return [flag]
+        distutils.log.warn('warning: compiler does not support time reports')
+        return []
+
+    def lto_flags(self):
+        # parallel link-time optimization: thin LTO on clang, LTRANS jobs on gcc >= 10
+        for flag in ('-flto=thin', '-flto=auto', '-flto'):
+            if self.has_flag(flag, link=True):
+                return [flag]
+        return []
+
+    def linker_flags(self, lto_flags):
+        if self.linker == 'default':
+            return []
+        elif self.linker != 'auto':
+            flags = ['-fuse-ld=' + self.linker]
+            if not self.has_flag(flags + lto_flags, link=True):
+                sys.exit('Linker is not available or does not support LTO: ' + self.linker)
+            return flags
+        for linker in LINKERS:
+            flags = ['-fuse-ld=' + linker]
+            if self.has_flag(flags + lto_flags, link=True):
+                return flags
+        return []
+
+    def size_flags(self, size):
+        compile_args, link_args = [], []
+        if not self.is_unix:
+            distutils.log.warn('warning: size optimizations are only supported on gcc / clang')
+            return compile_args, link_args
+        # place each function / object into its own section so unused ones can be dropped
+        sections = ['-ffunction-sections', '-fdata-sections']
+        if self.has_flag(sections):
+            compile_args.extend(sections)
+        gc = '-Wl,-dead_strip' if is_osx() else '-Wl,--gc-sections'
+        if self.has_flag(gc, link=True):
+            link_args.append(gc)
+        if size == 'min' and self.has_flag('-Os'):
+            # with LTO, code is generated at link time, so the flag has to be passed there too
+            compile_args.append('-Os')
+            link_args.append('-Os')
+        return compile_args, link_args
+
+    def strip(self, ext):
+        path = self.get_ext_fullpath(ext.name)
+        before = os.path.getsize(path)
+        if ext.size in ('strip', 'min'):
+            strip = self.env.get('STRIP') or os.environ.get('STRIP') or 'strip'
+            if shutil.which(strip) is None:
+                distutils.log.warn('warning: {!r} not found, not stripping symbols'.format(strip))
+            else:
+                # keep the symbols needed for dynamic linking (PyInit_*)
+                self.spawn([strip, '-x' if is_osx() else '--strip-unneeded', path])
+        after = os.path.getsize(path)
+        if after != before:
+            distutils.log.info('binary size: {} -> {} after stripping'.format(
+                format_size(before), format_size(after)))
+        else:
+            distutils.log.info('binary size: {}'.format(format_size(after)))
+
     def remove_flag(self, flag):
         for target in ('compiler', 'compiler_so'):
             cmd = getattr(self.compiler, target)
@@ -81,7 +280,7 @@ class build_ext(setuptools.command.build_ext.build_ext):
     def format_log(self, log):
         for ext in self.extensions:
             for source in ext.sources:
-                log = log.replace(source, '<source>')
+                log = log.replace(source, ext.source_labels.get(source, '<source>'))
                 basename = os.path.basename(source)
                 log = re.sub('^' + re.escape(basename) + r'\s+', '', log)
         log = re.sub(r'^/.+/(pybind11/[\w_]+\.h:)', r'\1',
@@ -90,33 +289,239 @@ class build_ext(setuptools.command.build_ext.build_ext):
                      log, flags=re.MULTILINE)
         return log
 
-    def build_extensions(self):
+    def handle_log(self, log):
+        if self.time_reports is not None:
+            reports, log = extract_gcc_reports(log)
+            self.time_reports.extend(reports)
+        # huge logs (e.g. template errors) are summarized before formatting, so that only
+        # the part that's actually shown has to be processed
+        summary, omitted = summarize(log, max_errors=self.max_errors)
+        if omitted:
+            # the full log is kept in the cache directory for further inspection
+            path = cache_path((self.log_name or self.extensions[0].name) + '.log')
+            with open(path, 'w') as f:
+                f.write(log)
+            summary += '[full log: {}]\n'.format(path)
+        return self.format_log(summary)
+
+    def report_time(self, ext):
+        reports, raw = [], []
+        if self.time_reports:
+            raw.append(('.time-report.txt', ''.join(self.time_reports)))
+            reports.extend(map(parse_gcc_report, self.time_reports))
+        for obj in self.compiler.object_filenames(ext.sources, output_dir=self.build_temp):
+            trace = os.path.splitext(obj)[0] + '.json'
+            if os.path.isfile(trace):
+                with open(trace) as f:
+                    raw.append(('.time-trace.json', f.read()))
+                reports.append(parse_clang_trace(raw[-1][1]))
+        # raw reports are kept in the cache directory for further inspection
+        for suffix, data in raw:
+            with open(cache_path(ext.name + suffix), 'w') as f:
+                f.write(data)
+        sep = '-' * 80 + '\n'
+        for report in reports:
+            sys.stdout.write(sep + format_report(report) + '\n')
+        if raw:
+            sys.stdout.write('raw report: {}\n'.format(cache_path(ext.name + raw[-1][0])))
+            sys.stdout.write(sep)
+        sys.stdout.flush()
+
+    def customize_compiler(self):
+        # environment overrides have to be visible to distutils while the compiler is being
+        # customized, but os.environ is process-wide, so this is done under a global lock
+        # (this also applies when there are no overrides since other builds may be running)
+        with _environ_lock, override_vars(os.environ, **self.env):
+            distutils.sysconfig.customize_compiler(self.compiler)
+
+    def prepare_compiler(self):
         if self.is_unix:
+            self.customize_compiler()
             self.remove_flag('-Wstrict-prototypes')  # may be an invalid flag on gcc
+
+    def extension_flags(self, ext):
+        std_flags = self.std_flags(ext.std)
+        if std_flags:
+            distutils.log.info('setting C++ standard: {}'.format(*std_flags))
+        compile_args = std_flags
+        link_args = []
+        if ext.native:
+            native_flags = self.native_flags()
+            if native_flags:
+                distutils.log.info('tuning for the host CPU: {}'.format(*native_flags))
+            compile_args.extend(native_flags)
+            link_args.extend(native_flags)
+        if ext.time_report:
+            compile_args.extend(self.time_report_flags())
+        if ext.size:
+            size_compile_args, size_link_args = self.size_flags(ext.size)
+            compile_args.extend(size_compile_args)
+            link_args.extend(size_link_args)
+        if self.is_unix:  # gcc / clang
+            if self.has_flag('-fvisibility=hidden'):
+                # set the default symbol visibility to hidden to obtain smaller binaries
+                compile_args.append('-fvisibility=hidden')
+            # enable link-time optimization if available
+            lto_flags = self.lto_flags() if ext.lto else []
+            compile_args.extend(lto_flags)
+            link_args.extend(lto_flags)
+            # use the fastest available linker since linking often dominates rebuilds
+            linker_flags = self.linker_flags(lto_flags)
+            if linker_flags:
+                distutils.log.info('using linker: {}'.format(*linker_flags))
+            link_args.extend(linker_flags)
+        elif self.is_msvc:  # msvc
+            compile_args.append('/MP')      # enable multithreaded builds
+            compile_args.append('/bigobj')  # because of 64k addressable sections limit
+            compile_args.append('/EHsc')    # catch synchronous C++ exceptions only
+        return compile_args, link_args
+
+    def build_extensions(self):
+        self.env = {k: v for ext in self.extensions for k, v in ext.env.items()}
+        self.scheduler = Scheduler.from_env(jobs=self.max_jobs, max_memory=self.max_memory,
+                                            max_cpu_time=self.max_cpu_time)
+        self.prepare_compiler()
         for ext in self.extensions:
-            std_flags = self.std_flags(ext.std)
-            if std_flags:
-                distutils.log.info('setting C++ standard: {}'.format(*std_flags))
-            compile_args = std_flags
-            link_args = []
-            if self.is_unix:  # gcc / clang
-                if self.has_flag('-fvisibility=hidden'):
-                    # set the default symbol visibility to hidden to obtain smaller binaries
-                    compile_args.append('-fvisibility=hidden')
-                if self.has_flag('-flto'):
-                    # enable link-time optimization if available
-                    compile_args.append('-flto')
-                    link_args.append('-flto')
-            elif self.is_msvc:  # msvc
-                compile_args.append('/MP')      # enable multithreaded builds
-                compile_args.append('/bigobj')  # because of 64k addressable sections limit
-                compile_args.append('/EHsc')    # catch synchronous C++ exceptions only
+            compile_args, link_args = self.extension_flags(ext)
             ext.extra_compile_args = compile_args + ext.extra_compile_args
             ext.extra_link_args = link_args + ext.extra_link_args
-        with spawn_capture(self.verbose and 'always' or 'on_error', handler=self.format_log,
-                           log_commands=bool(self.verbose)):
+        self.cancellation = Cancellation()
+        remote = None
+        if self.is_unix and (self.remote or os.environ.get('IPYBIND_BUILD_WORKERS')):
+            from ipybind.remote import RemotePool
+            remote = RemotePool.from_env(self.remote)
+        with spawn_capture(self.verbose and 'always' or 'on_error', handler=self.handle_log,
+                           log_commands=bool(self.verbose), env=self.env,
+                           scheduler=self.scheduler, cancel=self.cancellation, remote=remote):
             super().build_extensions()
 
+    def prewarm(self, nice=None):
+        """
+        Create the compiler and run the flag probes needed by the extensions without building
+        them; since the probe results are cached, this speeds up subsequent builds. Returns
+        `(compile_args, link_args)` that would be added to each extension.
+        """
+        self.env = {k: v for ext in self.extensions for k, v in ext.env.items()}
+        self.scheduler = Scheduler.from_env(nice=nice)
+        self.compiler = distutils.ccompiler.new_compiler(
+            compiler=self.compiler, verbose=self.verbose, dry_run=self.dry_run, force=self.force)
+        self.prepare_compiler()
+        return [self.extension_flags(ext) for ext in self.extensions]
+
+    def check_syntax(self, ext, errors, done):
+        # compiler output is captured in this thread and reported by the build thread
+        distutils.log.set_threshold(distutils.log.ERROR)
+        output = []
+        flags = [flag for flag in ext.extra_compile_args
+                 if not flag.startswith('-flto') and flag not in ('-ftime-trace', '-ftime-report')]
+        flags.append('/Zs' if self.is_msvc else '-fsyntax-only')
+        macros = ext.define_macros + [(macro,) for macro in ext.undef_macros]
+        try:
+            with tempfile.TemporaryDirectory() as d, \
+                    spawn_capture('never', handler=output.append, env=self.env,
+                                  scheduler=self.scheduler, cancel=done):
+                self.compiler.compile(ext.sources, output_dir=d, macros=macros,
+                                      include_dirs=ext.include_dirs, extra_postargs=flags,
+                                      depends=ext.depends)
+        except (distutils.errors.CompileError, distutils.errors.DistutilsExecError):
+            if not done.cancelled:
+                errors.append(''.join(output))
+                self.cancellation.cancel()
+
+    @contextlib.contextmanager
+    def syntax_check(self, ext):
+        """
+        Run a syntax-only compile concurrently with the build; since it's much faster than an
+        optimized compile, errors like typos can be reported without waiting for the build.
+        If the syntax check fails first, the build is cancelled.
+        """
+        errors, done = [], Cancellation()
+        thread = threading.Thread(target=self.check_syntax, args=(ext, errors, done),
+                                  name='ipybind-syntax-check', daemon=True)
+        thread.start()
+        try:
+            yield
+        finally:
+            done.cancel()
+            thread.join()
+            if errors and self.cancellation.cancelled:
+                log = self.handle_log(errors[0]).rstrip('\n')
+                sep = '-' * 80 + '\n'
+                sys.stdout.write(sep + log + '\n' + sep if log else '')
+                sys.stdout.flush()
+                raise distutils.errors.CompileError('syntax check failed')
+
+    def pch_flags(self, ext):
+        """
+        Get flags for using a precompiled header with pybind11 and the leading `#include`
+        block of the source (see `Extension.pch`), building it if needed.
+
+        The header doesn't include the preamble since it refers to the module name, and gcc
+        doesn't use a precompiled header if a macro it refers to is defined differently; the
+        sources still include everything themselves, so that's a no-op due to include guards.
+        A header is only precompiled once it's needed by a second build, since that's when
+        it starts to pay off; it's rebuilt when any of the headers it includes changes.
+        """
+        if ext.pch is None or not self.is_unix or len(ext.sources) != 1:
+            return []
+        compiler = self.compiler.compiler_so
+        identity = compiler_identity(compiler[0])
+        if identity is None or 'clang' in identity:
+            return []  # unlike gcc, clang fails instead of ignoring an unusable header
+        header = ''.join(line + '\n' for line in
+                         ['#include <pybind11/pybind11.h>', 'namespace py = pybind11;'] + ext.pch)
+        include_dirs = self.compiler.include_dirs + ext.include_dirs
+        flags = compiler[1:] + distutils.ccompiler.gen_preprocess_options([], include_dirs)
+        flags += ['-iquote', os.path.dirname(os.path.abspath(ext.sources[0]))]
+        flags += [flag for flag in ext.extra_compile_args
+                  if flag not in ('-ftime-trace', '-ftime-report')]
+        key = repr((compiler[0], identity, header, flags, sorted(self.env.items())))
+        path = cache_path('pch', hashlib.md5(key.encode('utf-8')).hexdigest()[:12] + '.h')
+        gch = path + '.gch'
+        with _pch_locks_lock:
+            lock = _pch_locks.setdefault(path, threading.Lock())
+        with lock:
+            if pch_deps_changed(gch):
+                if not os.path.isfile(path):
+                    os.makedirs(os.path.dirname(path), exist_ok=True)
+                    # other processes may be writing the same header concurrently
+                    tmp = '{}.{}.{}.tmp'.format(path, os.getpid(), threading.get_ident())
+                    with open(tmp, 'w') as f:
+                        f.write(header)
+                    os.replace(tmp, path)
+                    return []
+                distutils.log.info('precompiling headers: {}'.format(path))
+                tmp = '{}.{}.{}.tmp'.format(gch, os.getpid(), threading.get_ident())
+                try:
+                    with self.silence():
+                        self.compiler.spawn([compiler[0]] + flags + [
+                            '-x', 'c++-header', path, '-o', tmp, '-MD', '-MF', path + '.d'])
+                    os.replace(tmp, gch)
+                except distutils.errors.DistutilsExecError:
+                    distutils.log.warn('warning: failed to precompile headers')
+                    return []
+                finally:
+                    if os.path.exists(tmp):
+                        os.remove(tmp)
+                prune_pch(os.path.dirname(path))
+            else:
+                os.utime(gch)  # for pruning least recently used ones
+        return ['-include', path, '-Winvalid-pch']
+
+    def build_extension(self, ext):
+        self.time_reports = [] if ext.time_report else None
+        self.log_name = ext.name
+        ext.extra_compile_args = self.pch_flags(ext) + ext.extra_compile_args
+        try:
+            with self.syntax_check(ext) if ext.syntax_check else contextlib.ExitStack():
+                super().build_extension(ext)
+            if ext.size:
+                self.strip(ext)
+            if ext.time_report:
+                self.report_time(ext)
+        finally:
+            self.time_reports = None
+
     def copy_extensions_to_source(self):
         for ext in self.extensions:
             filename = self.get_ext_filename(self.get_ext_fullname(ext.name))
@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+
+import argparse
+import concurrent.futures
+import os
+import sys
+import time
+
+
+def build(args):
+    # the cache directory has to be set before anything is built
+    if args.cache_dir:
+        os.environ['IPYBIND_CACHE_DIR'] = args.cache_dir
+
+    from IPython.core.error import UsageError
+
+    from ipybind.common import cache_dir
+    from ipybind.magic import Pybind11Magics
+    from ipybind.notebook import read_cells, read_line_magics
+
+    cache_dir.cache_clear()
+    magics = Pybind11Magics()
+    verbose = ' -v' if args.verbose else ''
+
+    jobs, ok = [], True
+    for path in args.notebooks:
+        bundled = []
+        for index, line, cell in read_cells(path):
+            name = '{}[{}]'.format(os.path.basename(path), index)
+            cell_args = magics.parse_args(line)
+            if cell_args.bundle:
+                bundled.append((index, cell_args, line, cell))
+            elif cell_args.force:
+                print('{}: skipped, -f rebuilds the module on every run'.format(name))
+            else:
+                jobs.append((name, magics.build, (line + verbose, cell)))
+        for index, line in read_line_magics(path, 'pybind11_bundle'):
+            name = '{}[{}]'.format(os.path.basename(path), index)
+            bundle, _, options = line.partition(' ')
+            if magics.parse_args(options).force:
+                print('{}: skipped, -f rebuilds the module on every run'.format(name))
+                continue
+            # bundles only contain the cells that are run before them
+            bundle_magics = Pybind11Magics()
+            for cell_index, cell_args, cell_line, cell in bundled:
+                if cell_index < index and cell_args.bundle == bundle:
+                    try:
+                        bundle_magics.add_to_bundle(cell_args, cell_line, cell)
+                    except UsageError as e:
+                        print('{}[{}]: failed: {}'.format(os.path.basename(path), cell_index, e))
+                        ok = False
+            jobs.append((name, bundle_magics.build_bundle, (bundle, options + verbose)))
+
+    def build_cell(name, build, build_args):
+        start = time.time()
+        try:
+            module = build(*build_args)[1]
+        except (Exception, SystemExit) as e:
+            return name, 'failed: {}'.format(e), False
+        return name, '{} ({:.1f}s)'.format(module, time.time() - start), True
+
+    print('building {} cell(s) into {}'.format(len(jobs), cache_dir()))
+    with concurrent.futures.ThreadPoolExecutor(args.jobs or os.cpu_count()) as pool:
+        futures = [pool.submit(build_cell, *job) for job in jobs]
+        for future in concurrent.futures.as_completed(futures):
+            name, status, success = future.result()
+            ok = ok and success
+            print('{}: {}'.format(name, status))
+            sys.stdout.flush()
+    return 0 if ok else 1
+
+
+def export(args):
+    from ipybind.export import cache_source, export, notebook_sources
+    from ipybind.magic import Pybind11Magics
+
+    magics = Pybind11Magics()
+    sources = []
+    for source in args.sources:
+        if source.endswith('.ipynb'):
+            sources.extend(notebook_sources(magics, source, cells=args.cells))
+        else:
+            sources.append(cache_source(magics, source))
+    formats = [fmt for fmt in ('wheel', 'sdist') if getattr(args, fmt)] or ['wheel']
+    try:
+        files = export(magics, sources, name=args.name, version=args.version,
+                       formats=formats, dist_dir=args.dist_dir)
+    except (ValueError, RuntimeError) as e:
+        print('error: {}'.format(e))
+        return 1
+    for filename in files:
+        print(filename)
+    return 0
+
+
+def worker(args):
+    from ipybind.remote import serve
+
+    serve(host=args.host, port=args.port, jobs=args.jobs, compilers=args.compilers,
+          verbose=args.verbose)
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m ipybind')
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    p = commands.add_parser(
+        'build', help='Prebuild all %%%%pybind11 cells in notebooks into the cache.',
+        description='Prebuild all %%pybind11 cells and %pybind11_bundle bundles in notebooks '
+                    'in parallel, so that running them in a kernel using the same Python '
+                    'interpreter is a cache hit.')
+    p.add_argument('notebooks', nargs='+', metavar='NOTEBOOK',
+                   help='Path to the notebook (.ipynb) file.')
+    p.add_argument('--cache-dir', metavar='DIR',
+                   help='Target cache directory (defaults to $IPYBIND_CACHE_DIR or '
+                        '$IPYTHONDIR/pybind11); kernels pick it up via IPYBIND_CACHE_DIR.')
+    p.add_argument('-j', '--jobs', type=int, metavar='N',
+                   help='Number of cells to build in parallel (defaults to CPU count).')
+    p.add_argument('-v', '--verbose', action='store_true',
+                   help='Display compilation output.')
+    p.set_defaults(func=build)
+
+    p = commands.add_parser(
+        'export', help='Export cells as a standalone Python package.',
+        description='Export %%pybind11 cells from notebooks or cache entries (module names '
+                    'like pybind11_1a2b3c4 or paths to their .cpp files) as a standalone '
+                    'package which can be installed and imported without IPython.')
+    p.add_argument('sources', nargs='+', metavar='SOURCE',
+                   help='Notebook (.ipynb) file or a cache entry.')
+    p.add_argument('-c', '--cell', type=int, action='append', dest='cells', metavar='INDEX',
+                   help='Only export notebook cells with given indices (can be repeated).')
+    p.add_argument('-n', '--name',
+                   help='Package name (defaults to the module name if there is only one).')
+    p.add_argument('--version', default='0.1.0',
+                   help='Package version.')
+    p.add_argument('--wheel', action='store_true',
+                   help='Build a wheel (default).')
+    p.add_argument('--sdist', action='store_true',
+                   help='Build a source distribution.')
+    p.add_argument('-o', '--dist-dir', default='dist', metavar='DIR',
+                   help='Output directory, defaults to ./dist.')
+    p.set_defaults(func=export)
+
+    p = commands.add_parser(
+        'worker', help='Run a build worker for offloading compilation.',
+        description='Run a build worker which compiles preprocessed sources sent by ipybind '
+                    'builds (see --remote and IPYBIND_BUILD_WORKERS). There is no '
+                    'authentication, so only expose it to trusted hosts.')
+    p.add_argument('--host', default='127.0.0.1',
+                   help='Address to listen on, defaults to 127.0.0.1 (use 0.0.0.0 to listen '
+                        'on all interfaces).')
+    p.add_argument('--port', type=int, default=8765,
+                   help='Port to listen on, defaults to 8765.')
+    p.add_argument('-j', '--jobs', type=int, metavar='N',
+                   help='Number of concurrent compile jobs (defaults to CPU count).')
+    p.add_argument('--compiler', action='append', dest='compilers', metavar='NAME',
+                   help='Allow a compiler besides gcc/g++/cc/c++/clang/clang++ (can be repeated).')
+    p.add_argument('-v', '--verbose', action='store_true',
+                   help='Log requests.')
+    p.set_defaults(func=worker)
+
+    args = parser.parse_args(argv)
+    return args.func(args)
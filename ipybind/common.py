@@ -2,11 +2,16 @@
 
 import contextlib
 import functools
+import hashlib
 import imp
 import os
+import platform
+import re
 import shlex
+import subprocess
 import sys
 import sysconfig
+import tempfile
 
 from IPython import get_ipython
 from IPython.paths import get_ipython_cache_dir
@@ -20,7 +25,9 @@ def is_kernel():
 
 @functools.lru_cache()
 def cache_dir():
-    """Root cache directory for pybind11 extension."""
+    """Root cache directory for pybind11 extension (can be set via IPYBIND_CACHE_DIR)."""
+    if os.environ.get('IPYBIND_CACHE_DIR'):
+        return os.path.abspath(os.path.expanduser(os.environ['IPYBIND_CACHE_DIR']))
     root = os.path.abspath(os.path.expanduser(get_ipython_cache_dir()))
     return os.path.join(root, 'pybind11')
 
@@ -43,21 +50,207 @@ def ext_suffix():
     return sysconfig.get_config_var('EXT_SUFFIX')
 
 
+@functools.lru_cache()
+def cpu_features():
+    """Get a fingerprint of the host CPU's instruction set extensions."""
+    features = set()
+    try:
+        with open('/proc/cpuinfo') as f:
+            for line in f:
+                key, _, value = line.partition(':')
+                if key.strip() in ('flags', 'Features'):
+                    features.update(value.split())
+    except OSError:
+        pass
+    if not features and is_osx():
+        for key in ('machdep.cpu.features', 'machdep.cpu.leaf7_features'):
+            try:
+                out = subprocess.check_output(['sysctl', '-n', key], stderr=subprocess.DEVNULL)
+                features.update(out.decode('utf-8').lower().split())
+            except (OSError, subprocess.CalledProcessError):
+                pass
+    if not features:
+        features.add(platform.processor())
+    return '{}:{}'.format(platform.machine(), ' '.join(sorted(features)))
+
+
 def cache_path(*path):
     """Return an absolute path given a relative path within cache directory."""
     return os.path.join(cache_dir(), *path)
 
 
+def build_temp_dir():
+    """
+    Root directory for temporary build files (can be set via IPYBIND_BUILD_TEMP); defaults
+    to /dev/shm if available since object files don't need to be kept after the build.
+    """
+    if os.environ.get('IPYBIND_BUILD_TEMP'):
+        return os.path.abspath(os.path.expanduser(os.environ['IPYBIND_BUILD_TEMP']))
+    if os.path.isdir('/dev/shm') and os.access('/dev/shm', os.W_OK | os.X_OK):
+        return '/dev/shm'
+    return tempfile.gettempdir()
+
+
+@functools.lru_cache()
 def pybind11_get_include():
     """Get pybind11 include paths if it's installed as a Python package."""
     try:
         import pybind11
         try:
-            return [pybind11.get_include(True), pybind11.get_include(False)]
+            return (pybind11.get_include(True), pybind11.get_include(False))
         except AttributeError:
-            return []
+            return ()
     except ImportError:
-        return []
+        return ()
+
+
+@functools.lru_cache()
+def pybind11_internals_version():
+    """Get pybind11 internals version(s), which have to match for modules to interoperate."""
+    versions = set()
+    pattern = re.compile(r'define\s+PYBIND11_INTERNALS_VERSION\s+(\d+)')
+    for root in pybind11_get_include():
+        try:
+            with open(os.path.join(root, 'pybind11', 'detail', 'internals.h')) as f:
+                versions.update(pattern.findall(f.read()))
+        except OSError:
+            pass
+    return ','.join(sorted(versions)) or None
+
+
+# digests of header files, see file_digest
+_file_digests = {}
+
+# headers included by the code, see dependencies_digest
+_dependencies = {}
+
+
+def file_digest(path):
+    """Get a hash of the file contents, cached until its modification time or size changes."""
+    st = os.stat(path)
+    cached = _file_digests.get(path)
+    if cached is None or cached[0] != (st.st_mtime_ns, st.st_size):
+        with open(path, 'rb') as f:
+            cached = _file_digests[path] = (st.st_mtime_ns, st.st_size), \
+                hashlib.md5(f.read()).hexdigest()
+    return cached[1]
+
+
+def headers_digest(*dirs):
+    """Get a hash of the contents of all files in given include directories, if readable."""
+    md5 = hashlib.md5()
+    for root in dirs:
+        for dirpath, dirnames, filenames in os.walk(root):
+            dirnames.sort()
+            for filename in sorted(filenames):
+                path = os.path.join(dirpath, filename)
+                try:
+                    digest = file_digest(path)
+                except OSError:
+                    continue
+                md5.update(os.path.relpath(path, root).encode('utf-8'))
+                md5.update(digest.encode('ascii'))
+    return md5.hexdigest()
+
+
+def dependencies_changed(deps):
+    """Check whether any of the `(path, digest)` pairs is out of date (or unreadable)."""
+    try:
+        return any(file_digest(path) != digest for path, digest in deps)
+    except OSError:
+        return True
+
+
+def header_dependencies(compiler, flags, code, env=None):
+    """
+    Get `(path, digest)` pairs of all headers included by the code, as resolved by the
+    compiler (via `-M`) given the flags and environment; returns None if that fails. The
+    list of headers is reused until any of them changes.
+    """
+    key = compiler, tuple(flags), code, tuple(sorted((env or {}).items()))
+    deps = _dependencies.get(key)
+    if deps is not None and not dependencies_changed(deps):
+        return deps
+    try:
+        p = subprocess.Popen([compiler, '-M', '-x', 'c++'] + list(flags) + ['-'],
+                             stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                             stderr=subprocess.DEVNULL, env=dict(os.environ, **(env or {})))
+        out, _ = p.communicate(code.encode('utf-8'))
+        if p.returncode != 0:
+            return None
+        rule = out.decode('utf-8', 'replace').replace('\\\n', ' ')
+        paths = [path.replace('\\ ', ' ') for path in
+                 re.split(r'(?<!\\)\s+', rule.partition(': ')[2].strip()) if path]
+        deps = _dependencies[key] = [(path, file_digest(path)) for path in paths]
+    except OSError:
+        return None
+    return deps
+
+
+def dependencies_digest(compiler, flags, code, env=None):
+    """Get a hash of the contents of all headers included by the code (or None), see above."""
+    deps = header_dependencies(compiler, flags, code, env)
+    if deps is None:
+        return None
+    # the paths themselves don't matter, e.g. headers in another virtualenv may be the same
+    md5 = hashlib.md5()
+    for _, digest in deps:
+        md5.update(digest.encode('ascii'))
+    return md5.hexdigest()
+
+
+@functools.lru_cache()
+def compiler_identity(compiler):
+    """Get compiler version and target, e.g. to check that binaries are compatible."""
+    identity = []
+    for args in (['--version'], ['-dumpmachine']):
+        try:
+            out = subprocess.check_output([compiler] + args, stderr=subprocess.STDOUT)
+            identity.append(out.decode('utf-8', 'replace').splitlines()[0].strip())
+        except (OSError, subprocess.CalledProcessError, IndexError):
+            return None
+    return ' / '.join(identity)
+
+
+def default_compiler(env=None):
+    """Get the C/C++ compiler distutils would use, given environment overrides."""
+    cc = (env or {}).get('CC') or os.environ.get('CC') or sysconfig.get_config_var('CC')
+    return shlex.split(cc)[0] if cc else ('cl' if is_win() else 'cc')
+
+
+def abi_key(compiler, code=None, flags=(), env=None):
+    """
+    Get a fingerprint of everything the binaries depend on besides the code and the build
+    options: the extension ABI, pybind11 internals version, compiler identity and the
+    contents of all headers the code includes given the preprocessor flags (or, if they
+    can't be determined, of the ipybind and pybind11 headers). Unlike the interpreter path,
+    it's the same for all environments (e.g. virtualenvs) sharing the same Python build.
+    """
+    headers = None
+    if code is not None and not is_win():
+        headers = dependencies_digest(compiler, flags, code, env)
+    if headers is None:
+        include = [os.path.join(os.path.dirname(__file__), 'include')]
+        include.extend(os.path.join(root, 'pybind11')
+                       for root in dict.fromkeys(pybind11_get_include()))
+        headers = headers_digest(*include)
+    return {
+        'ext_suffix': ext_suffix(),
+        'soabi': sysconfig.get_config_var('SOABI'),
+        'platform': sysconfig.get_platform(),
+        'pybind11_internals': pybind11_internals_version(),
+        'compiler': compiler_identity(compiler),
+        'headers': headers,
+    }
+
+
+@functools.lru_cache()
+def conda_lib_root():
+    """Get the root of include / lib directories if running in a conda environment."""
+    if os.path.isdir(os.path.join(sys.prefix, 'conda-meta')):
+        if is_win():
+            return os.path.join(sys.prefix, 'Library')
+        return sys.prefix
 
 
 @contextlib.contextmanager
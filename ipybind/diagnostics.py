@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+
+import collections
+import re
+
+# gcc / clang: `file:line:col: error: message`; msvc: `file(line): error C1234: message`
+_DIAGNOSTIC_RE = re.compile(
+    r'^(?P<file>.*?)(?::(?P<line>\d+)(?::(?P<column>\d+))?:\s+|'
+    r'\((?P<mline>\d+)(?:,(?P<mcolumn>\d+))?\)\s*:\s*)'
+    r'(?P<severity>fatal error|error|warning|note)\b(?:\s+\w+)?:\s*(?P<message>.*)$')
+
+# lines preceding a diagnostic which describe where it comes from
+_CONTEXT_RE = re.compile(
+    r'^(?:In file included from |\s+from \S|.*?: (?:In|At) |'
+    r'.*?:\d+(?::\d+)?:\s+(?:recursively )?required (?:from|by) |In substitution of )')
+
+# template instantiation backtrace steps (gcc's context lines and clang's notes)
+_BACKTRACE_RE = re.compile(
+    r'(?:^.*?:\d+(?::\d+)?:\s+(?:recursively )?required (?:from|by) |'
+    r'^.*?:\d+(?::\d+)?:\s+note: in instantiation of |requested here$)')
+
+# source snippets following diagnostics, e.g. `   12 |   foo();` and `      |   ^~~`
+_SNIPPET_RE = re.compile(r'^\s*\d*\s+\|')
+
+Diagnostic = collections.namedtuple(
+    'Diagnostic', ['severity', 'file', 'line', 'column', 'message', 'lines', 'main'])
+Diagnostic.__doc__ = """
+A compiler diagnostic: severity is 'error', 'warning' or None (for output which is not a part of
+any diagnostic), `lines` are all lines of the diagnostic including its context and notes, and
+`lines[main]` is the line with the message itself.
+"""
+
+
+def parse_diagnostics(log):
+    """Split compiler output into diagnostics in a single pass over its lines."""
+    groups = []
+    lines, main, match = [], None, None
+
+    def flush():
+        if lines:
+            if match is None:
+                groups.append(Diagnostic(None, None, None, None, None, lines, None))
+            else:
+                severity = 'error' if match.group('severity') == 'fatal error' else \
+                    match.group('severity')
+                line = match.group('line') or match.group('mline')
+                column = match.group('column') or match.group('mcolumn')
+                groups.append(Diagnostic(
+                    severity, match.group('file'), line and int(line), column and int(column),
+                    match.group('message'), lines, main))
+
+    for text in log.splitlines():
+        m = _DIAGNOSTIC_RE.match(text)
+        if m is not None and m.group('severity') != 'note':
+            context = []
+            if match is not None:
+                # the trailing context lines (and their snippets) belong to this diagnostic,
+                # whereas notes of the previous one may have their own context lines
+                k = split = len(lines)
+                is_context = lambda line: _CONTEXT_RE.match(line) or _SNIPPET_RE.match(line)
+                while k > main + 1 and is_context(lines[k - 1]):
+                    k -= 1
+                    if _CONTEXT_RE.match(lines[k]):
+                        split = k
+                lines, context = lines[:split], lines[split:]
+                flush()
+                lines = context
+            main, match = len(lines), m
+        lines.append(text)
+    flush()
+    return groups
+
+
+def collapse_backtrace(lines, keep=(2, 1)):
+    """Collapse long runs of template instantiation steps, keeping the first and last ones."""
+    result, run = [], []
+
+    def flush():
+        steps = [i for i, line in enumerate(run) if _BACKTRACE_RE.search(line)]
+        if len(steps) > sum(keep) + 1:
+            head, tail = steps[keep[0]], steps[-keep[1]]
+            result.extend(run[:head])
+            result.append('    [... {} more instantiation steps ...]'.format(
+                len(steps) - sum(keep)))
+            result.extend(run[tail:])
+        else:
+            result.extend(run)
+        run.clear()
+
+    for line in lines:
+        if _BACKTRACE_RE.search(line) or (run and _SNIPPET_RE.match(line)):
+            run.append(line)
+        else:
+            flush()
+            result.append(line)
+    flush()
+    return result
+
+
+def summarize(log, max_errors=10, max_line_length=500):
+    """
+    Make compiler output readable: long template instantiation backtraces are collapsed,
+    contexts repeated for multiple diagnostics are only shown once, overly long lines are
+    truncated and only the first `max_errors` errors and warnings are kept (0 = no limit).
+    Returns the summary and whether anything has been left out.
+    """
+    counts, dropped = collections.Counter(), collections.Counter()
+    contexts, output, omitted = {}, [], False
+    for diag in parse_diagnostics(log):
+        if diag.severity is not None:
+            if max_errors and counts[diag.severity] >= max_errors:
+                dropped[diag.severity] += 1
+                continue
+            counts[diag.severity] += 1
+        lines = diag.lines
+        context = tuple(lines[:diag.main or 0])
+        if len(context) > 2 and context in contexts:
+            lines = ['[same context as {} #{} above]'.format(*contexts[context])] + \
+                lines[diag.main:]
+        elif context and diag.severity is not None:
+            contexts[context] = diag.severity, counts[diag.severity]
+        collapsed = collapse_backtrace(lines)
+        for line in collapsed:
+            if len(line) > max_line_length:
+                line = line[:max_line_length] + ' [...]'
+                omitted = True
+            output.append(line)
+        omitted = omitted or len(collapsed) != len(diag.lines)
+    if dropped:
+        output.append('[... {} not shown ...]'.format(' and '.join(
+            '{} more {}{}'.format(n, severity, 's' * (n > 1))
+            for severity, n in sorted(dropped.items()))))
+    summary = '\n'.join(output) + '\n' * log.endswith('\n')
+    return summary, omitted or bool(dropped)
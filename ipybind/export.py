@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+
+import json
+import os
+import shlex
+import shutil
+import subprocess
+import sys
+import tempfile
+
+import setuptools
+
+from ipybind.build_ext import build_ext
+from ipybind.common import cache_path, is_osx, is_win
+from ipybind.extension import Extension
+from ipybind.normalize import module_name
+
+_SETUP_PY = '''\
+# -*- coding: utf-8 -*-
+# generated by ipybind
+
+import os
+import sys
+
+import pybind11
+from setuptools import Extension, setup
+
+# environment variables the modules were built with (e.g. the compiler)
+for key, value in {env!r}.items():
+    os.environ.setdefault(key, value)
+
+include_dirs = ['include', pybind11.get_include()]
+library_dirs = []
+if os.path.isdir(os.path.join(sys.prefix, 'conda-meta')):
+    conda_root = os.path.join(sys.prefix, 'Library') if os.name == 'nt' else sys.prefix
+    include_dirs.append(os.path.join(conda_root, 'include'))
+    library_dirs.append(os.path.join(conda_root, 'lib'))
+
+setup(
+    name={name!r},
+    version={version!r},
+    ext_modules=[
+{extensions}
+    ],
+    zip_safe=False
+)
+'''
+
+_EXTENSION = '''\
+        Extension(
+            {name!r}, [{source!r}], language='c++',
+            include_dirs=include_dirs + {include_dirs!r},
+            library_dirs=library_dirs + {library_dirs!r},
+            runtime_library_dirs={runtime_library_dirs!r},
+            libraries={libraries!r},
+            define_macros={define_macros!r},
+            extra_compile_args={extra_compile_args!r},
+            extra_link_args={extra_link_args!r}
+        ),'''
+
+_PYPROJECT_TOML = '''\
+[build-system]
+requires = ["setuptools", "wheel", "pybind11"]
+build-backend = "setuptools.build_meta"
+'''
+
+_MANIFEST_IN = 'include *.cpp\ninclude include/*.h\n'
+
+
+def absolute_paths(args, base_dir):
+    """Resolve include / library directories relative to the given directory."""
+    def resolve(path):
+        return os.path.normpath(os.path.join(base_dir, os.path.expanduser(path)))
+
+    def resolve_flags(flags):
+        return ' '.join(flag[:2] + resolve(flag[2:]) if flag[:2] in ('-I', '-L') and flag[2:]
+                        else flag for flag in shlex.split(flags))
+
+    args.include_dirs = [resolve(path) for path in args.include_dirs]
+    args.library_dirs = [resolve(path) for path in args.library_dirs]
+    args.extra_compile_args = [resolve_flags(flags) for flags in args.extra_compile_args]
+    args.extra_link_args = [resolve_flags(flags) for flags in args.extra_link_args]
+    return args
+
+
+def notebook_sources(magics, path, cells=None):
+    """Get `(code, args)` for `%%pybind11` cells in a notebook (optionally, by cell index)."""
+    from ipybind.notebook import read_cells
+    base_dir = os.path.dirname(os.path.abspath(path))
+    return [(magics.format_code(cell), absolute_paths(magics.parse_args(line), base_dir))
+            for index, line, cell in read_cells(path) if not cells or index in cells]
+
+
+def cache_source(magics, entry):
+    """Get `(code, args)` for a cache entry, given either its module name or source path."""
+    if not entry.endswith('.cpp'):
+        entry = cache_path(entry + '.cpp')
+    with open(entry) as f:
+        code = f.read()
+    metadata = os.path.splitext(entry)[0] + '.json'
+    line, pinned = '', None
+    if os.path.isfile(metadata):
+        with open(metadata) as f:
+            metadata = json.load(f)
+        line, pinned = metadata.get('line', ''), metadata.get('pinned')
+    return code, absolute_paths(magics.parse_args(line, pinned), os.getcwd())
+
+
+def extension_kwargs(magics, module, args):
+    """
+    Get `setuptools.Extension` arguments for a module (besides the common include / library
+    directories, see `_SETUP_PY`), with the flags ipybind's `build_ext` adds resolved.
+    """
+    kwargs = dict(magics.extension_kwargs(args), time_report=False, syntax_check=False)
+    ext = Extension(module, [module + '.cpp'], **kwargs)
+    dist = setuptools.Distribution({'name': module, 'ext_modules': [ext]})
+    cmd = build_ext(dist)
+    cmd.linker = 'default'  # the package may be built where a faster linker is not available
+    cmd.ensure_finalized()
+    [(compile_args, link_args)] = cmd.prewarm()
+    if cmd.is_unix and args.size in ('strip', 'min'):
+        link_args.append('-Wl,-x' if is_osx() else '-s')
+    macros = [('_IPYBIND_MODULE_NAME', module)]
+    if args.profile_calls:
+        macros.append(('IPYBIND_PROFILE_CALLS', None))
+    return dict(
+        name=module,
+        source=module + '.cpp',
+        include_dirs=kwargs['include_dirs'],
+        library_dirs=kwargs['library_dirs'],
+        runtime_library_dirs=kwargs['library_dirs'] if not is_win() and not is_osx() else [],
+        libraries=kwargs['libraries'],
+        define_macros=macros,
+        extra_compile_args=compile_args + kwargs['extra_compile_args'],
+        extra_link_args=link_args + kwargs['extra_link_args'],
+    )
+
+
+def export(magics, sources, name=None, version='0.1.0', formats=('wheel',), dist_dir='dist'):
+    """
+    Export `(code, args)` pairs as a standalone Python package with an extension module each.
+
+    The flags ipybind's `build_ext` would add (C++ standard, LTO, visibility, size and CPU
+    tuning) are resolved for the current compiler and written into a plain setuptools
+    `setup.py`, so neither building the package nor the resulting binaries depend on
+    ipybind or IPython. Returns the list of built distribution files.
+    """
+    modules = {}
+    for code, args in sources:
+        module = module_name(code)
+        if module in modules:
+            raise ValueError('duplicate module name: {}'.format(module))
+        modules[module] = code, args
+    if not modules:
+        raise ValueError('nothing to export')
+    if name is None:
+        if len(modules) > 1:
+            raise ValueError('package name is required when exporting multiple modules')
+        name = next(iter(modules))
+
+    modules = sorted(modules.items())
+    env = {}
+    for _, (_, args) in modules:
+        for key, value in magics.extension_kwargs(args)['env'].items():
+            if env.setdefault(key, value) != value:
+                raise ValueError('conflicting values of {} in environment overrides'.format(key))
+    extensions = [extension_kwargs(magics, module, args) for module, (_, args) in modules]
+
+    dist_dir = os.path.abspath(dist_dir)
+    os.makedirs(dist_dir, exist_ok=True)
+    with tempfile.TemporaryDirectory() as root:
+        for module, (code, _) in modules:
+            with open(os.path.join(root, module + '.cpp'), 'w') as f:
+                f.write(code)
+        os.makedirs(os.path.join(root, 'include'))
+        shutil.copy(os.path.join(os.path.dirname(__file__), 'include', 'pybind11_preamble.h'),
+                    os.path.join(root, 'include'))
+        files = {
+            'setup.py': _SETUP_PY.format(name=name, version=version, env=env, extensions='\n'.join(
+                _EXTENSION.format(**kwargs) for kwargs in extensions)),
+            'pyproject.toml': _PYPROJECT_TOML,
+            'MANIFEST.in': _MANIFEST_IN,
+        }
+        for filename, contents in files.items():
+            with open(os.path.join(root, filename), 'w') as f:
+                f.write(contents)
+
+        before = {f: os.path.getmtime(os.path.join(dist_dir, f)) for f in os.listdir(dist_dir)}
+        for fmt in formats:
+            command = {'wheel': 'bdist_wheel', 'sdist': 'sdist'}[fmt]
+            p = subprocess.Popen([sys.executable, 'setup.py', command, '--dist-dir', dist_dir],
+                                 cwd=root, stdout=subprocess.PIPE,
+                                 stderr=subprocess.STDOUT)
+            out, _ = p.communicate()
+            if p.returncode != 0:
+                sys.stdout.write(out.decode('utf-8', 'replace'))
+                raise RuntimeError('failed to build {} for {}'.format(fmt, name))
+    return sorted(os.path.join(dist_dir, f) for f in os.listdir(dist_dir)
+                  if before.get(f) != os.path.getmtime(os.path.join(dist_dir, f)))
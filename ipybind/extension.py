@@ -1,16 +1,17 @@
 # -*- coding: utf-8 -*-
 
 import os
-import sys
 
 import setuptools
 
-from ipybind.common import pybind11_get_include, is_win, is_osx
+from ipybind.common import conda_lib_root, pybind11_get_include, is_win, is_osx
 
 
 class Extension(setuptools.Extension):
     def __init__(self, module, sources, include_dirs=None, library_dirs=None,
-                 libraries=None, extra_compile_args=None, extra_link_args=None, std=None):
+                 libraries=None, extra_compile_args=None, extra_link_args=None, std=None,
+                 native=False, env=None, profile_calls=False, time_report=False, size=None,
+                 syntax_check=False, source_labels=None, lto=True, pch=None):
         ext_include_dirs = []
         ext_library_dirs = []
         ext_extra_compile_args = []
@@ -23,12 +24,10 @@ class Extension(setuptools.Extension):
         include.extend(pybind11_get_include())
 
         # for conda environments, add conda-specific include/lib dirs
-        if os.path.isdir(os.path.join(sys.prefix, 'conda-meta')):
-            conda_lib_root = sys.prefix
-            if is_win():
-                conda_lib_root = os.path.join(sys.prefix, 'Library')
-            include.append(os.path.join(conda_lib_root, 'include'))
-            ext_library_dirs.append(os.path.join(conda_lib_root, 'lib'))
+        conda_root = conda_lib_root()
+        if conda_root is not None:
+            include.append(os.path.join(conda_root, 'include'))
+            ext_library_dirs.append(os.path.join(conda_root, 'lib'))
 
         # add pybind11 and conda include dirs as -isystem on gcc/clang
         if is_win():
@@ -51,6 +50,35 @@ class Extension(setuptools.Extension):
         # store C++ standard so it can be used by build_ext to figure out the flags
         self.std = std
 
+        # whether to tune the code for the host CPU (handled by build_ext as well)
+        self.native = native
+
+        # environment variable overrides, applied to this build only (see build_ext)
+        self.env = env or {}
+
+        # whether to report compile time breakdown (see build_ext)
+        self.time_report = time_report
+
+        # binary size optimization level: None, 'gc', 'strip' or 'min' (see build_ext)
+        self.size = size
+
+        # whether to run a fast syntax-only compile alongside the build (see build_ext)
+        self.syntax_check = syntax_check
+
+        # whether to enable link-time optimization if it's supported (see build_ext)
+        self.lto = lto
+
+        # leading #include directives of the source to precompile, or None (see build_ext)
+        self.pch = pch
+
+        # source file labels to show in compiler messages instead of '<source>' (see build_ext)
+        self.source_labels = source_labels or {}
+
+        define_macros = [('_IPYBIND_MODULE_NAME', module)]
+        if profile_calls:
+            # see pybind11_preamble.h
+            define_macros.append(('IPYBIND_PROFILE_CALLS', None))
+
         super().__init__(
             name=module,
             sources=sources,
@@ -61,7 +89,5 @@ class Extension(setuptools.Extension):
             extra_link_args=extra_link_args or [],
             libraries=libraries or [],
             language='c++',
-            define_macros=[
-                ('_IPYBIND_MODULE_NAME', module)
-            ]
+            define_macros=define_macros
         )
@@ -2,5 +2,139 @@
 
 namespace py = pybind11;
 
-#define _PYBIND11_PLUGIN(name) PYBIND11_PLUGIN(_IPYBIND_MODULE_NAME)
-#define _PYBIND11_MODULE(name, m) PYBIND11_MODULE(_IPYBIND_MODULE_NAME, m)
+// bundles (%pybind11_bundle): each cell is compiled separately and defines a function which
+// initializes the cell's submodule (or returns its module for PYBIND11_PLUGIN); the functions
+// are then called from the init function of the bundle module defined in a separate source
+#ifdef _IPYBIND_CELL_INIT
+#  define _PYBIND11_PLUGIN(name) PyObject *_IPYBIND_CELL_INIT()
+#  define _IPYBIND_MODULE_DEF(m) void _IPYBIND_CELL_INIT(py::module &m)
+#else
+#  define _PYBIND11_PLUGIN(name) PYBIND11_PLUGIN(_IPYBIND_MODULE_NAME)
+#  define _IPYBIND_MODULE_DEF(m) PYBIND11_MODULE(_IPYBIND_MODULE_NAME, m)
+#endif
+#define _PYBIND11_MODULE(name, m) _IPYBIND_MODULE_DEF(m)
+
+// function multi-versioning: IPYBIND_TARGET_CLONES("avx2", "default") compiles the function
+// for each of the listed targets and picks the best one for the host CPU at load time
+#if defined(__has_attribute)
+#  if __has_attribute(target_clones) && defined(__ELF__) && \
+      (defined(__x86_64__) || defined(__i386__))
+#    define IPYBIND_TARGET_CLONES(...) __attribute__((target_clones(__VA_ARGS__)))
+#  endif
+#endif
+#ifndef IPYBIND_TARGET_CLONES
+#  define IPYBIND_TARGET_CLONES(...)
+#endif
+#define IPYBIND_MULTIVERSION IPYBIND_TARGET_CLONES("avx2", "default")
+
+// per-function call profiling (--profile-calls): module-level functions defined via m.def()
+// in PYBIND11_MODULE are wrapped with call counters and timers; the statistics are available
+// via module's __ipybind_stats__() function (in bundles, the statistics for all cells are
+// exported by the bundle module); this compiles to nothing unless enabled
+#ifdef IPYBIND_PROFILE_CALLS
+
+#include <chrono>
+#include <cstdint>
+#include <deque>
+#include <string>
+#include <type_traits>
+#include <utility>
+
+namespace ipybind {
+
+struct call_stats {
+    std::string name;
+    std::uint64_t calls;
+    std::uint64_t total_ns;
+};
+
+inline std::deque<call_stats> &registry() {
+    static std::deque<call_stats> stats;  // deque, so that pointers to elements are stable
+    return stats;
+}
+
+inline call_stats *get_stats(const char *name) {
+    for (auto &s : registry())
+        if (s.name == name)
+            return &s;  // overloads share the stats
+    registry().push_back(call_stats{name, 0, 0});
+    return &registry().back();
+}
+
+struct scoped_timer {
+    using clock = std::chrono::steady_clock;
+    call_stats *stats;
+    clock::time_point start;
+    explicit scoped_timer(call_stats *s) : stats(s), start(clock::now()) {}
+    ~scoped_timer() {
+        auto elapsed = std::chrono::duration_cast<std::chrono::nanoseconds>(clock::now() - start);
+        stats->calls += 1;
+        stats->total_ns += static_cast<std::uint64_t>(elapsed.count());
+    }
+};
+
+template <typename F, typename R, typename... Args>
+struct timed_function {
+    mutable typename std::decay<F>::type f;
+    call_stats *stats;
+    R operator()(Args... args) const {
+        scoped_timer timer(stats);
+        return f(std::forward<Args>(args)...);
+    }
+};
+
+class profiled_module : public py::module {
+public:
+    explicit profiled_module(const py::module &m) : py::module(m) {}
+
+    template <typename Func, typename... Extra>
+    profiled_module &def(const char *name_, Func &&f, const Extra &...extra) {
+        using signature = py::detail::function_signature_t<typename std::remove_reference<Func>::type>;
+        py::module::def(name_, wrap(get_stats(name_), std::forward<Func>(f), (signature *) nullptr),
+                        extra...);
+        return *this;
+    }
+
+private:
+    template <typename F, typename R, typename... Args>
+    static timed_function<F, R, Args...> wrap(call_stats *stats, F &&f, R (*)(Args...)) {
+        return timed_function<F, R, Args...>{std::forward<F>(f), stats};
+    }
+};
+
+inline void export_stats(py::module &m) {
+    m.def("__ipybind_stats__", [](bool reset) {
+        py::dict result;
+        for (auto &s : registry()) {
+            double total = s.total_ns * 1e-9;
+            py::dict d;
+            d["calls"] = s.calls;
+            d["total"] = total;
+            d["mean"] = s.calls ? total / s.calls : 0.0;
+            result[py::str(s.name)] = d;
+            if (reset)
+                s.calls = s.total_ns = 0;
+        }
+        return result;
+    }, py::arg("reset") = false, "Get (and optionally reset) per-function call statistics.");
+}
+
+}  // namespace ipybind
+
+#ifdef _IPYBIND_CELL_INIT
+#  define _IPYBIND_EXPORT_STATS(m)
+#else
+#  define _IPYBIND_EXPORT_STATS(m) ipybind::export_stats(m);
+#endif
+
+#undef _PYBIND11_MODULE
+#define _PYBIND11_MODULE(name, m)                                                       \
+    static void _ipybind_module_init(ipybind::profiled_module &);                        \
+    _IPYBIND_MODULE_DEF(_ipybind_m) {                                                    \
+        _IPYBIND_EXPORT_STATS(_ipybind_m)                                                \
+        ipybind::profiled_module _ipybind_pm(_ipybind_m);                                \
+        _ipybind_module_init(_ipybind_pm);                                               \
+    }                                                                                    \
+    static void _ipybind_module_init(ipybind::profiled_module &m)
+
+#endif
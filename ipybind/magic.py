@@ -1,26 +1,111 @@
 # -*- coding: utf-8 -*_
 
+import argparse
+import collections
+import concurrent.futures
+import difflib
 import hashlib
 import imp
+import json
 import os
+import re
 import shlex
+import shutil
 import sys
+import sysconfig
+import tempfile
+import textwrap
+import threading
 import time
+import timeit
+import types
 import warnings
 
 import setuptools
 
+from IPython.core.error import UsageError
 from IPython.core.magic import Magics, magics_class, cell_magic, line_magic, on_off
 from IPython.core.magic_arguments import argument, magic_arguments
 
 from ipybind.build_ext import build_ext
-from ipybind.common import ext_suffix, cache_path, is_kernel, override_vars
+from ipybind.common import (abi_key, build_temp_dir, ext_suffix, cache_path, cpu_features,
+                            default_compiler, dependencies_changed, header_dependencies,
+                            is_kernel, is_win)
 from ipybind.extension import Extension
-from ipybind.stream import start_forwarding, stop_forwarding
+from ipybind.normalize import leading_includes, module_declaration, normalize_code
+from ipybind.scheduler import parse_size
+from ipybind.stream import CellCapture, start_forwarding, stop_forwarding
+
+# modules currently being built; building the same module concurrently is serialized
+_build_locks = collections.defaultdict(threading.Lock)
+_build_locks_lock = threading.Lock()
+
+# names referenced in a cell (see Pybind11Magics.calls_native)
+_IDENTIFIER_RE = re.compile(r'[A-Za-z_]\w*')
+
+# guards the file with autotuned options pinned for cells
+_pins_lock = threading.Lock()
+
+# configurations tried by %%pybind11_autotune by default
+AUTOTUNE_CONFIGS = [
+    '',
+    '-c=-O2',
+    '--no-lto',
+    '--native',
+    '-c=-ffast-math',
+    '--native -c=-ffast-math',
+]
+
+
+def autotune_configs():
+    configs = list(AUTOTUNE_CONFIGS)
+    if shutil.which('clang') and shutil.which('clang++'):
+        configs += ['-e CC clang -e CXX clang++', '-e CC clang -e CXX clang++ --native']
+    return configs
+
+
+def format_time(seconds):
+    for unit, scale in (('s', 1), ('ms', 1e-3), ('us', 1e-6)):
+        if seconds >= scale:
+            return '{:.3g} {}'.format(seconds / scale, unit)
+    return '{:.3g} ns'.format(seconds * 1e9)
+
+
+def bench_timer(stmt, namespace):
+    """Create a timer running the statement in the given namespace (like `globals` in 3.5+)."""
+    timer = timeit.Timer()
+    body = textwrap.indent(textwrap.dedent(stmt), ' ' * 8)
+    source = ('def inner(_it, _timer):\n    _t0 = _timer()\n    for _i in _it:\n{}\n'
+              '    return _timer() - _t0\n').format(body)
+    exec(compile(source, '<bench>', 'exec'), namespace)
+    timer.inner = namespace.pop('inner')
+    return timer
+
+
+def flatten_key(key, prefix=''):
+    """Flatten nested key inputs (e.g. the ABI key) into `{'abi.compiler': ..., ...}`."""
+    result = {}
+    for k, v in key.items():
+        if isinstance(v, dict):
+            result.update(flatten_key(v, prefix + k + '.'))
+        else:
+            result[prefix + k] = v
+    return result
 
 
 @magics_class
 class Pybind11Magics(Magics):
+    def __init__(self, shell=None, **kwargs):
+        super().__init__(shell=shell, **kwargs)
+        self.modules = collections.OrderedDict()  # all modules imported in this session
+        # (line, cell) -> (module name, symbols, headers) for cells run in this session
+        self.memo = {}
+        self.bundles = collections.defaultdict(collections.OrderedDict)  # name -> {cell: ...}
+        self.built_bundles = {}  # name -> (module, cells it was built from)
+        self.cell_capture = CellCapture()  # see %pybind11_capture auto
+        self.pins = None  # options pinned for cells, see %%pybind11_autotune
+        self.capture_hooks = False
+
     @magic_arguments()
     @argument('-f', '--force', action='store_true',
               help='Force recompilation of the module.')
@@ -44,6 +129,50 @@ class Pybind11Magics(Magics):
               help='Extra flags to pass to the linker.')
     @argument('-m', '--module', action='store_true',
               help='Import the module object instead of its contents.')
+    @argument('--native', action='store_true',
+              help='Tune the build for the host CPU (-march=native).')
+    @argument('--no-native', action='store_false', dest='native', default=argparse.SUPPRESS,
+              help='Do not tune the build for the host CPU (e.g. if --native is pinned).')
+    @argument('--normalize', action='store_true',
+              help='Ignore comments and whitespace when computing the module hash.')
+    @argument('--cache-key', choices=['interpreter', 'abi'],
+              help='What cached binaries are keyed by besides the code and the options: the '
+                   'interpreter (default, or $IPYBIND_CACHE_KEY), or the extension ABI, so '
+                   'that they can be shared by environments using the same Python build.')
+    @argument('--profile-calls', action='store_true',
+              help='Collect per-function call statistics (see %%pybind11_stats).')
+    @argument('--time-report', action='store_true',
+              help='Report where the compile time is spent (headers, templates, phases).')
+    @argument('--no-lto', action='store_false', dest='lto',
+              help='Disable link-time optimization.')
+    @argument('--lto', action='store_true', default=argparse.SUPPRESS,
+              help='Enable link-time optimization (e.g. if --no-lto is pinned).')
+    @argument('--no-pch', action='store_false', dest='pch',
+              help='Do not precompile pybind11 and the leading #include block of the cell.')
+    @argument('--size', choices=['gc', 'strip', 'min'],
+              help='Reduce the binary size: drop unused sections (gc), also strip symbols '
+                   '(strip), also optimize for size (min).')
+    @argument('--syntax-check', action='store_true',
+              help='Run a fast syntax-only compile alongside the build to report errors early.')
+    @argument('--max-errors', type=int, metavar='N',
+              help='Show at most N compiler errors and N warnings (default: 10, 0: no limit).')
+    @argument('-j', '--jobs', type=int, metavar='N',
+              help='Limit the number of concurrent compiler processes on this host.')
+    @argument('--max-memory', type=parse_size, metavar='SIZE',
+              help='Memory limit for each compiler process (e.g. 2G).')
+    @argument('--max-cpu-time', type=int, metavar='SECONDS',
+              help='CPU time limit for each compiler process.')
+    @argument('--build-temp', metavar='DIR',
+              help='Directory for temporary build files, defaults to /dev/shm or $TMPDIR.')
+    @argument('--linker', choices=['auto', 'mold', 'lld', 'gold', 'default'],
+              help='Linker to use, defaults to the fastest available one.')
+    @argument('--remote', metavar='HOST:PORT[,...]',
+              help='Build workers to offload compilation to, defaults to $IPYBIND_BUILD_WORKERS.')
+    @argument('--explain', action='store_true',
+              help='Report whether the cell is cached and, if not, how it differs from the '
+                   'nearest cached entries, without building anything.')
+    @argument('--bundle', metavar='NAME',
+              help='Add the cell to a bundle instead of building it (see %%pybind11_bundle).')
     @cell_magic
     def pybind11(self, line, cell):
         """
@@ -55,16 +184,446 @@ class Pybind11Magics(Magics):
         current namespace.
         """
 
-        line = line.strip().rstrip(';')
-        args = self.pybind11.parser.parse_args(shlex.split(line))
+        # unchanged cells which have already been run are re-imported directly, without
+        # parsing the arguments, hashing the code or touching the file system (other than
+        # checking the included headers if they are part of the cache key, see key_headers)
+        memo = self.memo.pop((line, cell), None)
+        if memo is not None and not (memo[2] and dependencies_changed(memo[2])):
+            self.memo[(line, cell)] = memo  # most recently run last, see %pybind11_snapshot
+            self.shell.push(memo[1])
+            return
+
+        args = self.parse_args(line)
+        if args.explain:
+            self.explain(line, cell)
+            return
+        if args.bundle:
+            name = self.add_to_bundle(args, line, cell)
+            built = self.built_bundles.get(args.bundle)
+            if built is not None and built[1].get(name, (None, None))[1] == cell:
+                self.shell.push(self.bundled_symbols(built[0], name, line))
+            else:
+                print('Added {} to bundle {}; build it via %pybind11_bundle {}.'
+                      .format(name, args.bundle, args.bundle))
+            return
+
+        args, module, libfile = self.build(line, cell)
+        symbols = self.import_module(module, libfile, import_symbols=not args.module)
+        if not args.force:
+            self.memo.pop((line, cell), None)
+            self.memo[(line, cell)] = module, symbols, self.key_headers(cell, args)
+
+    def build(self, line, cell, pinned=True):
+        """
+        Build a pybind11 cell unless it's already cached, without importing it.
+
+        Returns a tuple of parsed magic arguments, module name and path to the module binary.
+        This method is thread-safe, so multiple cells may be built concurrently. Unless
+        `pinned` is false, options pinned for the cell via `%%pybind11_autotune` are used
+        as defaults.
+        """
+
+        pins = self.load_pins().get(self.pin_key(cell)) if pinned else None
+        args = self.parse_args(line, pins)
         code = self.format_code(cell)
-        module = 'pybind11_{}'.format(self.compute_hash(code, args))
+        inputs = self.key_inputs(code, args)
+        module = 'pybind11_{}'.format(self.hash_key(inputs))
         libfile = cache_path(module + ext_suffix())
         need_rebuild = not os.path.isfile(libfile) or args.force
         if need_rebuild:
-            source = self.save_source(code, module)
-            self.build_module(module, source, args)
-        self.import_module(module, libfile, import_symbols=not args.module)
+            source = self.save_source(code, module, line=line, pinned=pins,
+                                      key=self.describe_key(inputs))
+            pch = args.pch and os.environ.get('IPYBIND_PCH', '1').lower() not in (
+                '0', 'false', 'no', 'off')
+            self.build_module(module, [source], args, pch=leading_includes(cell) if pch else None)
+        return args, module, libfile
+
+    def explain(self, line, cell, limit=3):
+        """
+        Report whether a cell would be rebuilt and, if so, how its key inputs differ from
+        the nearest cached entries (the ones with the fewest differences, newest first).
+        """
+
+        args = self.parse_args(line, self.load_pins().get(self.pin_key(cell)))
+        if args.bundle:
+            raise UsageError('--explain does not apply to bundled cells.')
+        if args.force:
+            # -f makes every module name unique, so explain what would be built without it
+            print('-f rebuilds the cell on every run; the rest of the options are compared.')
+            args.force = False
+        code = self.format_code(cell)
+        inputs = self.key_inputs(code, args)
+        module = 'pybind11_{}'.format(self.hash_key(inputs))
+        if os.path.isfile(cache_path(module + ext_suffix())):
+            print('Cache hit: {}.'.format(module))
+            return
+        key = flatten_key(self.describe_key(inputs))
+        print('Cache miss: {} would be built.'.format(module))
+        if os.path.isfile(cache_path(module + '.json')):
+            print('{} has been built before, but its binary is no longer in the cache '
+                  '(or the build failed).'.format(module))
+
+        entries = []
+        for filename in os.listdir(cache_path()) if os.path.isdir(cache_path()) else []:
+            name, ext = os.path.splitext(filename)
+            if ext != '.json' or not name.startswith('pybind11_') or '.' in name \
+                    or name == module or not os.path.isfile(cache_path(name + ext_suffix())):
+                continue
+            try:
+                with open(cache_path(filename)) as f:
+                    cached = flatten_key(json.load(f)['key'])
+            except (OSError, ValueError, KeyError, TypeError):
+                continue  # built by an older version, or being written
+            diff = sorted(k for k in set(key) | set(cached) if key.get(k) != cached.get(k))
+            mtime = os.path.getmtime(cache_path(filename))
+            entries.append((len(diff), -mtime, name, cached, diff))
+        if not entries:
+            print('There are no cached entries with recorded key inputs to compare with.')
+        for n, _, name, cached, diff in sorted(entries)[:limit]:
+            print('\nNearest cached entry {} ({} difference{}):'.format(name, n, 's' * (n > 1)))
+            for k in diff:
+                if k != 'code':
+                    print('  {}: {} -> {}'.format(
+                        k, *(json.dumps(d[k]) if k in d else '<unset>' for d in (cached, key))))
+                    continue
+                print('  code:')
+                try:
+                    with open(cache_path(name + '.cpp')) as f:
+                        old = f.read()
+                except OSError:
+                    continue
+                lines = list(difflib.unified_diff(
+                    old.splitlines(), code.splitlines(), name + '.cpp', 'cell', n=1, lineterm=''))
+                for text in lines[:20]:
+                    print('    ' + text)
+                if len(lines) > 20:
+                    print('    [... {} more lines ...]'.format(len(lines) - 20))
+
+    @line_magic
+    def pybind11_bundle(self, line=''):
+        """
+        Build all cells added to a bundle via `%%pybind11 --bundle NAME` into one module.
+
+        Usage: `%pybind11_bundle NAME [options]`, where the options are the same as for
+        `%%pybind11` and apply to all cells in the bundle. Each cell is compiled separately
+        and becomes a submodule of the bundle module; its symbols are then imported just
+        like they would be if the cell was built on its own.
+        """
+
+        name, _, options = line.strip().partition(' ')
+        if not name:
+            raise UsageError('Bundle name is required.')
+        args, module, libfile, cells = self.build_bundle(name, options)
+        mod = imp.load_dynamic(module, libfile)
+        self.modules[module] = mod
+        self.built_bundles[name] = mod, cells
+        symbols = {}
+        for cell_name, (cell_line, _) in cells.items():
+            symbols.update(self.bundled_symbols(mod, cell_name, cell_line))
+        self.shell.push(symbols)
+
+    def add_to_bundle(self, args, line, cell):
+        """Add a cell to a bundle and return the name of its submodule."""
+        defaults = vars(self.parse_args(''))
+        for key, value in vars(args).items():
+            if key not in ('bundle', 'module', 'verbose') and value != defaults[key]:
+                raise UsageError('Build options for bundled cells have to be passed to '
+                                 '%pybind11_bundle.')
+        try:
+            _, name = module_declaration(cell)
+        except ValueError as e:
+            raise UsageError(str(e))
+        self.bundles[args.bundle][name] = line, cell
+        return name
+
+    def bundled_symbols(self, mod, name, line):
+        submodule = getattr(mod, name)
+        if self.parse_args(line).module:
+            return {name: submodule}
+        return {k: v for k, v in submodule.__dict__.items() if not k.startswith('__')}
+
+    def format_bundle(self, cells):
+        """Get the code of the bundle module init source, and the code of each cell."""
+        sources = collections.OrderedDict()
+        declarations, calls = [], []
+        for name, (_, cell) in cells.items():
+            # the cell is compiled with its own init function, which is set in a header that
+            # replaces the preamble include, so that line numbers still match the cell
+            init = '_ipybind_init_' + name
+            sources[name] = self.format_code(cell).replace(
+                '#include <pybind11_preamble.h>', '#include "bundle/{}.h"'.format(name), 1)
+            if module_declaration(cell)[0] == 'PLUGIN':
+                declarations.append('PyObject *{}();'.format(init))
+                calls.append('    m.add_object("{}", py::reinterpret_steal<py::object>({}()));'
+                             .format(name, init))
+            else:
+                declarations.append('void {}(py::module &);'.format(init))
+                calls.append('    {{ auto sub = m.def_submodule("{}"); {}(sub); }}'
+                             .format(name, init))
+        main = '\n'.join([
+            '#include <pybind11_preamble.h>',
+            '',
+        ] + declarations + [
+            '',
+            'PYBIND11_MODULE(_IPYBIND_MODULE_NAME, m) {',
+            '#ifdef IPYBIND_PROFILE_CALLS',
+            '    ipybind::export_stats(m);',
+            '#endif',
+        ] + calls + [
+            '}',
+            ''
+        ])
+        return main, sources
+
+    def save_bundle_header(self, name):
+        filename = cache_path('bundle', name + '.h')
+        code = '#define _IPYBIND_CELL_INIT _ipybind_init_{}\n#include <pybind11_preamble.h>\n'
+        code = code.format(name)
+        if os.path.isfile(filename):
+            with open(filename) as f:
+                if f.read() == code:
+                    return
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        tmp = '{}.{}.tmp'.format(filename, threading.get_ident())
+        with open(tmp, 'w') as f:
+            f.write(code)
+        os.replace(tmp, filename)  # other builds may be reading it
+
+    def build_bundle(self, name, line):
+        """
+        Build all cells in a bundle into one module unless it's already cached.
+
+        Returns a tuple of parsed arguments, module name, path to the module binary and
+        the cells the module was built from.
+        """
+
+        cells = collections.OrderedDict(self.bundles.get(name, {}))
+        if not cells:
+            raise UsageError('Bundle {0} is empty; add cells to it via '
+                             '%%pybind11 --bundle {0}.'.format(name))
+        args = self.parse_args(line)
+        if args.bundle or args.module:
+            raise UsageError('--bundle and -m options only apply to bundled cells.')
+        main, sources = self.format_bundle(cells)
+        inputs = self.key_inputs(main + ''.join(sources.values()), args)
+        module = 'pybind11_{}'.format(self.hash_key(inputs))
+        libfile = cache_path(module + ext_suffix())
+        if not os.path.isfile(libfile) or args.force:
+            for cell_name in cells:
+                self.save_bundle_header(cell_name)
+            files = [self.save_source(main, module, line=line, bundle=name, cells=list(cells),
+                                      key=self.describe_key(inputs))]
+            labels = {}
+            for cell_name, code in sources.items():
+                files.append(self.save_source(code, '{}.{}'.format(module, cell_name),
+                                              line=cells[cell_name][0]))
+                labels[files[-1]] = '<{}>'.format(cell_name)
+            self.build_module(module, files, args, source_labels=labels)
+        return args, module, libfile, cells
+
+    @magic_arguments()
+    @argument('-b', '--bench', required=True, metavar='EXPR',
+              help='Python statement to benchmark, with the module symbols imported.')
+    @argument('--config', action='append', default=[], metavar='OPTIONS',
+              help='Options for %%%%pybind11 to try (can be repeated), e.g. '
+                   '--config="--native -c=-O2"; defaults to a predefined set.')
+    @argument('-r', '--repeat', type=int, default=5, metavar='N',
+              help='Number of timing runs, the best one is reported (defaults to 5).')
+    @argument('-j', '--jobs', type=int, metavar='N',
+              help='Number of configurations to build in parallel (defaults to CPU count).')
+    @argument('--pin', action='store_true',
+              help='Use the options of the fastest configuration for this cell by default.')
+    @argument('--unpin', action='store_true',
+              help='Remove the options pinned for this cell and exit.')
+    @cell_magic
+    def pybind11_autotune(self, line, cell):
+        """
+        Build a pybind11 cell in several configurations and benchmark each of them.
+
+        The configurations are built in parallel. Each module is then benchmarked by timing
+        the given statement with its symbols imported on top of the user namespace, and a
+        table ranked by the best time is printed. The symbols from the fastest module are
+        imported into the current namespace.
+
+        With `--pin`, the options of the fastest configuration are stored in the cache
+        directory and used by `%%pybind11` for this cell from then on (explicitly passed
+        options take precedence); editing the cell code other than its comments and
+        whitespace invalidates the pinned options.
+        """
+
+        args = self.pybind11_autotune.parser.parse_args(shlex.split(line))
+        if args.unpin:
+            self.save_pin(cell, None)
+            print('Pinned options for this cell have been removed.')
+            return
+        configs = args.config or autotune_configs()
+
+        def build(config):
+            try:
+                return self.build(config, cell, pinned=False)
+            except (Exception, SystemExit) as e:
+                return e
+
+        with concurrent.futures.ThreadPoolExecutor(args.jobs or os.cpu_count()) as pool:
+            results = list(pool.map(build, configs))
+
+        rows = []
+        for config, result in zip(configs, results):
+            if isinstance(result, BaseException):
+                rows.append((config, None, None, 'build failed: {}'.format(result)))
+                continue
+            config_args, module, libfile = result
+            mod = imp.load_dynamic(module, libfile)
+            symbols = self.module_symbols(mod, import_symbols=not config_args.module)
+            try:
+                timer = bench_timer(args.bench, dict(self.shell.user_ns, **symbols))
+                number = 1
+                while timer.timeit(number) < 0.2:
+                    number *= 10
+                best = min(timer.repeat(args.repeat, number)) / number
+            except Exception as e:
+                rows.append((config, result, None, 'benchmark failed: {!r}'.format(e)))
+                continue
+            rows.append((config, result, best, None))
+
+        baseline = rows[0][2]
+        ranked = sorted((row for row in rows if row[2] is not None), key=lambda row: row[2])
+        width = max(len('config'), *(len(config or '(default)') for config in configs))
+        fmt = '{:>4}  {:<%d}  {:>10}  {:>8}' % width
+        print(fmt.format('rank', 'config', 'time', 'speedup'))
+        for rank, (config, _, best, _) in enumerate(ranked, 1):
+            speedup = '{:.2f}x'.format(baseline / best) if baseline else ''
+            print(fmt.format(rank, config or '(default)', format_time(best), speedup))
+        for config, _, _, error in rows:
+            if error is not None:
+                print('{:>4}  {:<{}}  {}'.format('-', config or '(default)', width, error))
+        if not ranked:
+            return
+
+        config, (config_args, module, libfile), _, _ = ranked[0]
+        self.import_module(module, libfile, import_symbols=not config_args.module)
+        if args.pin:
+            self.save_pin(cell, config)
+            print('Pinned options for this cell: {}'.format(config or '(default)'))
+
+    def pin_key(self, cell):
+        return hashlib.md5(normalize_code(cell).encode('utf-8')).hexdigest()
+
+    def load_pins(self, reload=False):
+        if self.pins is None or reload:
+            try:
+                with open(cache_path('autotune.json')) as f:
+                    self.pins = json.load(f)
+            except (OSError, ValueError):
+                self.pins = {}
+        return self.pins
+
+    def save_pin(self, cell, options):
+        with _pins_lock:
+            pins = dict(self.load_pins(reload=True))
+            if options is None:
+                pins.pop(self.pin_key(cell), None)
+            else:
+                pins[self.pin_key(cell)] = options
+            filename = cache_path('autotune.json')
+            os.makedirs(os.path.dirname(filename), exist_ok=True)
+            with open(filename + '.tmp', 'w') as f:
+                json.dump(pins, f, indent=4, sort_keys=True)
+            os.replace(filename + '.tmp', filename)
+            self.pins = pins
+        # cells run before may now resolve to a different module
+        self.memo = {key: value for key, value in self.memo.items() if key[1] != cell}
+
+    def snapshot_path(self, line):
+        """Get the snapshot file: the given one, or one per notebook in the cache directory."""
+        if line.strip():
+            return os.path.abspath(os.path.expanduser(line.strip()))
+        notebook = self.shell.user_ns.get('__session__') or \
+            self.shell.user_ns.get('__vsc_ipynb_file__')
+        if not notebook:
+            raise UsageError('Cannot determine the notebook path, pass the snapshot file '
+                             'explicitly.')
+        digest = hashlib.md5(os.path.abspath(notebook).encode('utf-8')).hexdigest()[:12]
+        return cache_path('snapshots', '{}-{}.json'.format(
+            os.path.splitext(os.path.basename(notebook))[0], digest))
+
+    @line_magic
+    def pybind11_snapshot(self, line=''):
+        """
+        Save the `%%pybind11` cells run in this session to a file, so that all of them can be
+        restored at once via `%pybind11_restore` (e.g. after restarting the kernel).
+
+        Usage: `%pybind11_snapshot [FILE]`, where the file defaults to one per notebook in
+        the `snapshots` cache subdirectory (if the notebook path is known to the kernel).
+        Cells built with `-f` and bundles are not saved.
+        """
+
+        filename = self.snapshot_path(line)
+        cells = [{'line': cell_line, 'cell': cell, 'module': module}
+                 for (cell_line, cell), (module, _, _) in self.memo.items()]
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(filename),
+                                   prefix=os.path.basename(filename) + '.', suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump({'version': 1, 'cells': cells}, f, indent=4, sort_keys=True)
+            os.replace(tmp, filename)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+        print('Saved {} cell(s) to {}.'.format(len(cells), filename))
+
+    @line_magic
+    def pybind11_restore(self, line=''):
+        """
+        Restore the cells saved via `%pybind11_snapshot`, as if they were run in the same order.
+
+        Usage: `%pybind11_restore [FILE]`. The module name of each cell is recomputed (so that
+        binaries built by another environment or with other options are never imported) and
+        the module is imported from the cache directly; the ones missing from the cache are
+        rebuilt in parallel. The symbols are then pushed into the namespace at once, and
+        re-running any of the cells afterwards doesn't rebuild or reload anything.
+        """
+
+        filename = self.snapshot_path(line)
+        try:
+            with open(filename) as f:
+                cells = json.load(f)['cells']
+        except (OSError, ValueError, KeyError) as e:
+            raise UsageError('Cannot read snapshot {}: {}'.format(filename, e))
+
+        def locate(entry):
+            line, cell = entry['line'], entry['cell']
+            args = self.parse_args(line, self.load_pins().get(self.pin_key(cell)))
+            module = 'pybind11_{}'.format(self.compute_hash(self.format_code(cell), args))
+            libfile = cache_path(module + ext_suffix())
+            if module in self.modules or os.path.isfile(libfile):
+                return args, module, libfile, False
+            return self.build(line, cell) + (True,)
+
+        with concurrent.futures.ThreadPoolExecutor(os.cpu_count()) as pool:
+            futures = [pool.submit(locate, entry) for entry in cells]
+        symbols, rebuilt, failed = {}, 0, 0
+        for entry, future in zip(cells, futures):
+            try:
+                args, module, libfile, built = future.result()
+            except (Exception, SystemExit) as e:
+                print('Failed to restore {}: {}'.format(entry['module'], e))
+                failed += 1
+                continue
+            rebuilt += built
+            mod = self.modules.get(module)
+            if mod is None:
+                mod = self.modules[module] = imp.load_dynamic(module, libfile)
+            cell_symbols = self.module_symbols(mod, not args.module)
+            self.memo.pop((entry['line'], entry['cell']), None)
+            self.memo[(entry['line'], entry['cell'])] = \
+                module, cell_symbols, self.key_headers(entry['cell'], args)
+            symbols.update(cell_symbols)
+        self.shell.push(symbols)
+        failures = ', {} failed'.format(failed) if failed else ''
+        print('Restored {} cell(s) from {} ({} rebuilt{}).'.format(
+            len(cells) - failed, filename, rebuilt, failures))
 
     @line_magic
     def pybind11_capture(self, parameter_s=''):
@@ -74,6 +633,10 @@ class Pybind11Magics(Magics):
         To enable:  `%pybind11_capture 1` or `%pybind11_capture on`.
         To disable: `%pybind11_capture 0` or `%pybind11_capture off`.
         To toggle:  `%pybind11_capture`.
+
+        To only capture the output of cells calling into pybind11 modules built in this
+        session: `%pybind11_capture auto`. The streams are then redirected just for these
+        cells, and the output is shown when the cell finishes.
         """
 
         if not is_kernel():
@@ -83,22 +646,162 @@ class Pybind11Magics(Magics):
         p = parameter_s.strip().lower()
         if p:
             try:
-                capture = {'off': 0, '0': 0, 'on': 1, '1': 1}[p]
+                capture = {'off': 0, '0': 0, 'on': 1, '1': 1, 'auto': 'auto'}[p]
             except KeyError:
-                print('Incorrect argument. Use on/1, off/0, or nothing for a toggle.')
+                print('Incorrect argument. Use on/1, off/0, auto, or nothing for a toggle.')
                 return
         else:
             capture = not getattr(self.shell, 'pybind11_capture', False)
         self.shell.pybind11_capture = capture
-        (start_forwarding if capture else stop_forwarding)()
-        print('C++ stdout/stderr capturing has been turned', on_off(capture))
+        self.register_capture_hooks(capture == 'auto')
+        if capture == 'auto':
+            stop_forwarding()
+            print('C++ stdout/stderr capturing has been turned on for cells calling into '
+                  'pybind11 modules')
+        else:
+            (start_forwarding if capture else stop_forwarding)()
+            print('C++ stdout/stderr capturing has been turned', on_off(capture))
+
+    def register_capture_hooks(self, enable):
+        if enable == self.capture_hooks:
+            return
+        if not enable:
+            self.cell_capture.stop()  # in case it's called from a cell being captured
+        register = self.shell.events.register if enable else self.shell.events.unregister
+        register('pre_run_cell', self.pre_run_cell)
+        register('post_run_cell', self.post_run_cell)
+        self.capture_hooks = enable
+
+    def pre_run_cell(self, info):
+        if self.calls_native(info.raw_cell or ''):
+            self.cell_capture.start()
+
+    def post_run_cell(self, result):
+        self.cell_capture.stop()
+
+    def calls_native(self, cell):
+        """
+        Check whether the code refers to anything from pybind11 modules built in this session,
+        either directly or via functions defined in the notebook.
+        """
+        if not self.modules:
+            return False
+        ns = self.shell.user_ns
+        # PYBIND11_PLUGIN modules may be named differently from the binaries
+        modules = set(self.modules).union(mod.__name__ for mod in self.modules.values())
+
+        def is_native(obj, nested=False):
+            if isinstance(obj, types.ModuleType):
+                module = obj.__name__
+            else:
+                module = getattr(obj, '__module__', None)
+            if isinstance(module, str) and module.partition('.')[0] in modules:
+                return True
+            code = getattr(obj, '__code__', None)
+            if not nested and code is not None and getattr(obj, '__globals__', None) is ns:
+                return any(is_native(ns[name], True) for name in code.co_names if name in ns)
+            return False
+
+        return any(is_native(ns[name]) for name in set(_IDENTIFIER_RE.findall(cell))
+                   if name in ns)
+
+    @magic_arguments()
+    @argument('-r', '--reset', action='store_true',
+              help='Reset the statistics after printing them.')
+    @argument('-s', '--sort', choices=['calls', 'total', 'mean'], default='total',
+              help='Sort key, defaults to total time.')
+    @argument('-n', '--limit', type=int, metavar='N',
+              help='Only show the top N functions.')
+    @line_magic
+    def pybind11_stats(self, line=''):
+        """
+        Print call statistics for functions in modules built with `--profile-calls`.
+
+        For each function, the number of calls and total / mean time spent in the C++
+        code are reported (time spent converting the arguments is not included).
+        """
+
+        args = self.pybind11_stats.parser.parse_args(shlex.split(line))
+        rows = []
+        for name, mod in self.modules.items():
+            if hasattr(mod, '__ipybind_stats__'):
+                for func, stats in mod.__ipybind_stats__(args.reset).items():
+                    rows.append((func, name, stats['calls'], stats['total'], stats['mean']))
+        if not rows:
+            print('No call statistics available; build modules with --profile-calls.')
+            return
+        key = {'calls': 2, 'total': 3, 'mean': 4}[args.sort]
+        rows = sorted(rows, key=lambda row: row[key], reverse=True)[:args.limit]
+        width = max(len('function'), *(len(row[0]) for row in rows))
+        fmt = '{:<%d}  {:<16}  {:>10}  {:>10}  {:>10}' % width
+        print(fmt.format('function', 'module', 'calls', 'total', 'mean'))
+        for func, module, calls, total, mean in rows:
+            print(fmt.format(func, module, calls, format_time(total), format_time(mean)))
+
+    def parse_args(self, line, pinned=None):
+        """
+        Parse the magic line. Pinned options (see `%%pybind11_autotune`) are used as defaults:
+        the ones given explicitly replace them, except for environment overrides, which are
+        merged by variable.
+        """
+        parser = self.pybind11.parser
+        line = line.strip().rstrip(';')
+        if not pinned:
+            return parser.parse_args(shlex.split(line))
+        args = parser.parse_args(shlex.split(pinned))
+        explicit = argparse.Namespace(**{action.dest: None for action in parser._actions})
+        parser.parse_args(shlex.split(line), namespace=explicit)
+        for key, value in vars(explicit).items():
+            if key == 'env' and value is not None:
+                value = [list(item) for item in dict(args.env + value).items()]
+            if value is not None:
+                setattr(args, key, value)
+        return args
 
     def compute_hash(self, code, args):
+        return self.hash_key(self.key_inputs(code, args))
+
+    def hash_key(self, inputs):
+        return hashlib.md5(str(sorted(inputs.items())).encode('utf-8')).hexdigest()[:7]
+
+    def describe_key(self, inputs):
+        """Make the key inputs JSON-serializable, replacing the code with its digest."""
+        inputs = dict(inputs, code=hashlib.md5(inputs['code'].encode('utf-8')).hexdigest())
+        return json.loads(json.dumps(inputs, default=str))
+
+    def key_headers(self, cell, args):
+        """
+        Get `(path, digest)` pairs of the headers included by the cell if they are a part of
+        its cache key (i.e. it's keyed by the ABI), so that memoized cells can be rebuilt
+        when any of them changes.
+        """
+        if is_win() or (args.cache_key or os.environ.get('IPYBIND_CACHE_KEY')) != 'abi':
+            return None  # see abi_key
+        ext = self.extension_kwargs(args)
+        return header_dependencies(default_compiler(ext['env']), self.preprocess_flags(ext),
+                                   self.format_code(cell), ext['env'])
+
+    def key_inputs(self, code, args):
+        """Get everything the module name (i.e. the cache key) of the code depends on."""
+        ext = self.extension_kwargs(args)
         args = vars(args).copy()
-        args['version_info'] = sys.version_info
-        args['executable'] = sys.executable
-        args['code'] = code
-        args.pop('verbose', None)
+        cache_key = args.pop('cache_key', None) or os.environ.get('IPYBIND_CACHE_KEY')
+        if cache_key == 'abi':
+            args['abi'] = abi_key(default_compiler(ext['env']), code,
+                                  self.preprocess_flags(ext), ext['env'])
+        elif cache_key in (None, '', 'interpreter'):
+            args['version_info'] = sys.version_info
+            args['executable'] = sys.executable
+        else:
+            raise UsageError('invalid IPYBIND_CACHE_KEY: {!r}'.format(cache_key))
+        args['code'] = normalize_code(code) if args['normalize'] else code
+        if args['native']:
+            # binaries tuned for the host CPU may crash on other machines sharing the cache
+            args['cpu_features'] = cpu_features()
+        for key in ('verbose', 'jobs', 'max_memory', 'max_cpu_time', 'linker',
+                    'build_temp', 'syntax_check', 'bundle', 'remote', 'pch', 'max_errors',
+                    'explain'):
+            args.pop(key, None)
         if args.pop('force', False):
             # Force-rebuilding changes the hash on Windows; we have to do that because
             # python.exe keeps open handles to the loaded .pyd files, and we can't
@@ -106,8 +809,19 @@ class Pybind11Magics(Magics):
             # seems to work fine, however importing the module with the same name as
             # already imported module may be flaky, so we have to make it unique too.
             args['timestamp'] = int(round(time.time() * 1e6))
-        key = str(sorted(args.items()))
-        return hashlib.md5(key.encode('utf-8')).hexdigest()[:7]
+        return args
+
+    def preprocess_flags(self, kwargs):
+        """Get the flags which determine the headers a cell includes, given Extension kwargs."""
+        ext = Extension('pybind11_deps', [], **kwargs)
+        include_dirs = ext.include_dirs + [sysconfig.get_paths()['include']]
+        flags = ['-I' + path for path in include_dirs] + ext.extra_compile_args
+        flags += ['-D{}={}'.format(*macro) if macro[1] is not None else '-D' + macro[0]
+                  for macro in ext.define_macros]
+        flags.append('-std=' + (ext.std or 'c++14'))
+        for var in ('CPPFLAGS', 'CFLAGS'):
+            flags.extend(shlex.split(ext.env.get(var, os.environ.get(var, ''))))
+        return flags
 
     def format_code(self, cell):
         code = cell.replace('PYBIND11_PLUGIN', '_PYBIND11_PLUGIN')
@@ -116,50 +830,80 @@ class Pybind11Magics(Magics):
         code += '\n' * (not code.endswith('\n'))
         return code
 
-    def save_source(self, code, module):
+    def save_source(self, code, module, **metadata):
         filename = cache_path(module + '.cpp')
         os.makedirs(os.path.dirname(filename), exist_ok=True)
         with open(filename, 'w') as f:
             f.write(code)
+        # metadata (like the magic line) is stored next to the source for other tools
+        with open(cache_path(module + '.json'), 'w') as f:
+            json.dump(metadata, f, indent=4, sort_keys=True)
         return filename
 
-    def make_extension(self, module, source, args):
-        return Extension(
-            module,
-            [source],
+    def extension_kwargs(self, args):
+        return dict(
             include_dirs=args.include_dirs,
             library_dirs=args.library_dirs,
             libraries=args.libraries,
             extra_compile_args=[arg for c in args.extra_compile_args for arg in shlex.split(c)],
             extra_link_args=[arg for c in args.extra_link_args for arg in shlex.split(c)],
-            std=args.std
+            std=args.std,
+            native=args.native,
+            env={k.strip(): v for k, v in args.env},
+            profile_calls=args.profile_calls,
+            time_report=args.time_report,
+            size=args.size,
+            syntax_check=args.syntax_check,
+            lto=args.lto
         )
 
-    def build_module(self, module, source, args):
-        keys, values = list(zip(*args.env)) or ((), ())
-        env = dict(zip(map(str.strip, keys), values))
-        with override_vars(os.environ, **env):
-            workdir = cache_path(module)
-            os.makedirs(workdir, exist_ok=True)
+    def make_extension(self, module, sources, args, **kwargs):
+        return Extension(module, sources, **dict(self.extension_kwargs(args), **kwargs))
+
+    def build_module(self, module, sources, args, **kwargs):
+        with _build_locks_lock:
+            lock = _build_locks[module]
+        with lock:
+            # object files are only needed during the build, so they are kept in a scratch
+            # directory (preferably in RAM) instead of the cache directory
+            root = args.build_temp or build_temp_dir()
+            os.makedirs(root, exist_ok=True)
+            workdir = tempfile.mkdtemp(prefix='ipybind-{}-'.format(module), dir=root)
             script_args = ['-v' if args.verbose else '-q']
-            script_args += ['build_ext', '--inplace', '--build-temp', workdir]
+            script_args += ['build_ext', '--inplace',
+                            '--build-temp', os.path.join(workdir, 'temp'),
+                            '--build-lib', os.path.join(workdir, 'lib')]
             if args.force:
                 script_args.append('--force')
             if args.compiler is not None:
                 script_args += ['--compiler', args.compiler]
+            for option, value in (('--max-jobs', args.jobs),
+                                  ('--max-memory', args.max_memory),
+                                  ('--max-cpu-time', args.max_cpu_time),
+                                  ('--linker', args.linker),
+                                  ('--remote', args.remote),
+                                  ('--max-errors', args.max_errors)):
+                if value is not None:
+                    script_args += [option, str(value)]
             warnings.filterwarnings('ignore', 'To exit')
-            setuptools.setup(
-                name=module,
-                ext_modules=[self.make_extension(module, source, args)],
-                script_args=script_args,
-                cmdclass={'build_ext': build_ext}
-            )
+            try:
+                setuptools.setup(
+                    name=module,
+                    ext_modules=[self.make_extension(module, sources, args, **kwargs)],
+                    script_args=script_args,
+                    cmdclass={'build_ext': build_ext}
+                )
+            finally:
+                shutil.rmtree(workdir, ignore_errors=True)
+
+    def module_symbols(self, mod, import_symbols=True):
+        if import_symbols:
+            return {k: v for k, v in mod.__dict__.items() if not k.startswith('__')}
+        return {mod.__name__: mod}
 
     def import_module(self, module, libfile, import_symbols=True):
         mod = imp.load_dynamic(module, libfile)
-        if import_symbols:
-            for k, v in mod.__dict__.items():
-                if not k.startswith('__'):
-                    self.shell.push({k: v})
-        else:
-            self.shell.push({mod.__name__: mod})
+        self.modules[module] = mod
+        symbols = self.module_symbols(mod, import_symbols)
+        self.shell.push(symbols)
+        return symbols
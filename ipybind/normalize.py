@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+
+import re
+
+_TOKEN_RE = re.compile(r'''
+    (?P<raw>(?:u8|[uUL])?R"(?P<delim>[^()\\\s]{0,16})\(.*?\)(?P=delim)")
+  | (?P<string>(?:u8|[uUL])?"(?:\\.|[^"\\\n])*")
+  | (?P<number>\.?\d(?:[eEpP][+-]|'[0-9a-zA-Z_]|[\w.])*)
+  | (?P<char>(?:u8|[uUL])?'(?:\\.|[^'\\\n])*')
+  | (?P<comment>//[^\n]*|/\*.*?\*/)
+  | (?P<newline>\n)
+  | (?P<space>[ \t\r\f\v]+)
+  | (?P<word>\w+)
+  | (?P<punct>.)
+''', re.VERBOSE | re.DOTALL)
+
+_HEADER_RE = re.compile(r'[ \t]*(<[^>\n]*>)')
+
+# module declaration, e.g. `PYBIND11_MODULE(name, m)` (or `_PYBIND11_...` once formatted)
+_MODULE_RE = re.compile(r'(?<!\w)_?PYBIND11_(MODULE|PLUGIN)\s*\(\s*(\w+)')
+
+# pairs of punctuators which would form a different token if glued together
+_GLUED = set("""
+    ++ -- << >> -> :: && || += -= *= /= %= &= |= ^= == != <= >= .* .. // /* ## <: :> <% %> %:
+""".split())
+
+
+def _needs_space(prev, text):
+    word = prev[-1].isalnum() or prev[-1] == '_'
+    if word != (text[0].isalnum() or text[0] == '_'):
+        return False
+    return word or prev[-1] + text[0] in _GLUED
+
+
+def cpp_tokens(code):
+    """
+    Split C++ code into a list of significant tokens.
+
+    Comments and whitespace are dropped. Newlines are only kept at the end of
+    preprocessor directives where they are significant; a single space is kept
+    between two tokens that would otherwise be glued together (e.g. `a + +b`).
+    """
+    code = code.replace('\\\n', '')
+    tokens = []
+    pos, directive, bol, separated = 0, False, True, True
+    while pos < len(code):
+        m = _TOKEN_RE.match(code, pos)
+        kind, text, pos = m.lastgroup, m.group(), m.end()
+        if kind in ('space', 'comment'):
+            separated = True
+            continue
+        elif kind == 'newline':
+            if directive:
+                tokens.append('\n')
+            directive, bol, separated = False, True, True
+            continue
+        if bol and text == '#':
+            if tokens and tokens[-1] != '\n':
+                tokens.append('\n')
+            directive = True
+        elif directive and text in ('include', 'include_next') and tokens[-1] == '#':
+            # header names may contain spaces and comment-like sequences
+            header = _HEADER_RE.match(code, pos)
+            if header:
+                text += header.group(1)
+                pos = header.end()
+        if separated and tokens and tokens[-1] not in ('\n', '#'):
+            # in directives, whitespace may be significant, e.g. `#define F (x)`
+            if directive or _needs_space(tokens[-1], text):
+                tokens.append(' ')
+        tokens.append(text)
+        bol = separated = False
+    return tokens
+
+
+def normalize_code(code):
+    """
+    Strip comments and insignificant whitespace from C++ code.
+
+    The result is only meant to be used for computing cache keys; if the code
+    refers to `__LINE__`, it is returned as is since cosmetic edits may then
+    change the compiled binary.
+    """
+    tokens = cpp_tokens(code)
+    if '__LINE__' in tokens:
+        return code
+    return ''.join(tokens)
+
+
+_INCLUDE_RE = re.compile(r'#\s*include\s*(<[^>\n]+>|"[^"\n]+")\s*(//.*)?$')
+
+
+def leading_includes(code):
+    """
+    Get `#include` directives at the start of the code (blank lines and line comments in
+    between are skipped), without the comments; e.g. to precompile them.
+    """
+    includes = []
+    for line in code.splitlines():
+        line = line.strip()
+        if not line or line.startswith('//'):
+            continue
+        m = _INCLUDE_RE.match(line)
+        if m is None:
+            break
+        includes.append('#include ' + m.group(1))
+    return includes
+
+
+def module_declaration(code):
+    """Get `(kind, name)` of the module, where kind is either 'MODULE' or 'PLUGIN'."""
+    m = _MODULE_RE.search(code)
+    if m is None:
+        raise ValueError('no PYBIND11_MODULE or PYBIND11_PLUGIN found in the code')
+    return m.group(1), m.group(2)
+
+
+def module_name(code):
+    """Get the name of the module as declared in PYBIND11_MODULE / PYBIND11_PLUGIN."""
+    return module_declaration(code)[1]
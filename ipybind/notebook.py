@@ -1,5 +1,7 @@
 # -*- coding: utf-8 -*-
 
+import json
+
 from IPython.core.display import Javascript, HTML, display_javascript, display_html
 
 
@@ -23,3 +25,54 @@ def setup_notebook():
     </style>
     """
     display_html(HTML(data=html))
+
+
+def _code_cells(path):
+    with open(path, encoding='utf-8') as f:
+        nb = json.load(f)
+    if 'worksheets' in nb:  # nbformat v3
+        cells = [c for ws in nb['worksheets'] for c in ws.get('cells', [])]
+    else:
+        cells = nb.get('cells', [])
+    for index, c in enumerate(cells):
+        if c.get('cell_type') != 'code':
+            continue
+        source = c.get('source', c.get('input', ''))
+        if isinstance(source, list):
+            source = ''.join(source)
+        yield index, source
+
+
+def read_cells(path, magic='pybind11'):
+    """
+    Read all cells starting with a given cell magic from a notebook file.
+
+    Returns a list of `(index, line, cell)` tuples, where `index` is the cell's index in
+    the notebook, and `line` and `cell` are the arguments that IPython would pass to
+    the cell magic if the cell was executed.
+    """
+    prefix = '%%' + magic
+    result = []
+    for index, source in _code_cells(path):
+        first, _, cell = source.partition('\n')
+        if first.startswith(prefix) and first[len(prefix):len(prefix) + 1] in ('', ' ', ';'):
+            cell += '\n' * (not cell.endswith('\n'))  # IPython always appends a newline
+            result.append((index, first[len(prefix):], cell))
+    return result
+
+
+def read_line_magics(path, magic):
+    """
+    Read all calls of a given line magic from a notebook file.
+
+    Returns a list of `(index, line)` tuples, where `index` is the cell's index in the
+    notebook, and `line` is the argument that IPython would pass to the line magic.
+    """
+    prefix = '%' + magic
+    result = []
+    for index, source in _code_cells(path):
+        for line in source.splitlines():
+            line = line.strip()
+            if line.startswith(prefix) and line[len(prefix):len(prefix) + 1] in ('', ' '):
+                result.append((index, line[len(prefix):].strip()))
+    return result
@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import threading
+
+import distutils.log
+import setuptools
+
+from ipybind.build_ext import build_ext
+from ipybind.common import conda_lib_root, pybind11_get_include
+from ipybind.extension import Extension
+
+# niceness of the compiler processes spawned while prewarming
+PREWARM_NICE = 10
+
+_thread = None
+_thread_lock = threading.Lock()
+
+
+def _lower_priority():
+    # on Linux, priority can be set per thread (other platforms would lower it process-wide)
+    get_native_id = getattr(threading, 'get_native_id', None)  # Python 3.8+
+    if sys.platform.startswith('linux') and hasattr(os, 'setpriority') and get_native_id:
+        try:
+            os.setpriority(os.PRIO_PROCESS, get_native_id(), PREWARM_NICE)
+        except OSError:
+            pass
+
+
+def prewarm():
+    """
+    Do the one-time work that would otherwise be done by the first build in the session:
+    locate pybind11 / conda include directories and probe the compiler for supported flags.
+
+    All of the results are cached in a thread-safe way, so if a build starts in the middle,
+    it simply waits for the probes it needs (or runs the ones that haven't started yet).
+    """
+    pybind11_get_include()
+    conda_lib_root()
+    dist = setuptools.Distribution({'name': 'ipybind_prewarm',
+                                    'ext_modules': [Extension('ipybind_prewarm', [])]})
+    cmd = build_ext(dist)
+    cmd.ensure_finalized()
+    cmd.prewarm(nice=PREWARM_NICE)
+
+
+def _run():
+    distutils.log.set_threshold(distutils.log.ERROR)  # thread-local, see ipybind.spawn
+    try:
+        _lower_priority()
+        prewarm()
+    except BaseException:
+        pass  # whatever failed here will fail (and be reported) in the actual build
+
+
+def start_prewarm():
+    """Start prewarming in a background thread (unless disabled via IPYBIND_PREWARM=0)."""
+    global _thread
+    if os.environ.get('IPYBIND_PREWARM', '1').lower() in ('0', 'false', 'no', 'off'):
+        return None
+    with _thread_lock:
+        if _thread is None:
+            _thread = threading.Thread(target=_run, name='ipybind-prewarm', daemon=True)
+            _thread.start()
+        return _thread
@@ -0,0 +1,331 @@
+# -*- coding: utf-8 -*-
+
+import base64
+import http.server
+import itertools
+import json
+import os
+import re
+import socketserver
+import subprocess
+import tempfile
+import threading
+import time
+import urllib.request
+import zlib
+
+import distutils.log
+
+from ipybind.common import compiler_identity
+
+DEFAULT_PORT = 8765
+
+# preprocessed source suffixes, so that the compiler doesn't run the preprocessor again
+_SOURCE_SUFFIXES = {'.c': '.i', '.cc': '.ii', '.cpp': '.ii', '.cxx': '.ii', '.c++': '.ii'}
+
+# preprocessor flags, which are not needed to compile the preprocessed source
+_PP_FLAGS = ('-I', '-D', '-U', '-isystem', '-include', '-imacros', '-iquote', '-idirafter')
+
+# commands with these flags are always run locally (e.g. since they write extra files)
+_LOCAL_FLAGS = ('-E', '-M', '-x', '-fsyntax-only', '-ftime-trace', '-save-temps', '-fprofile')
+
+# code generation flags a worker accepts (anything else, e.g. linker flags, is refused)
+_SAFE_FLAG_RE = re.compile(r'^(?:-c|-w|-pthread|-pipe|-pedantic(?:-errors)?|-O\w*|-g\w*|'
+                           r'-std=[\w+]+|-m[\w.+=-]+|-f[\w.+=,/-]+|-W[\w.+=-]+)$')
+
+# flags matching the above which may still read, write or run arbitrary files on the worker
+_UNSAFE_FLAGS = ('-X', '-Wl,', '-Wa,', '-Wp,', '-fplugin', '-fpass-plugin', '-fuse-ld',
+                 '-fprofile', '-fcs-profile', '-fauto-profile', '-fmemory-profile', '-fdump',
+                 '-fsanitize-ignorelist', '-fsanitize-blacklist', '-fsanitize-system',
+                 '-fsanitize-coverage-allowlist', '-fsanitize-coverage-ignorelist', '-fxray',
+                 '-fcrash-diagnostics', '-fmodule', '-fprebuilt-module', '-fthinlto-index',
+                 '-fcoverage', '-ftest-coverage', '-fcallgraph-info', '-fstack-usage',
+                 '-fopt-info', '-fsave-optimization-record', '-foptimization-record',
+                 '-fsave-stats', '-ftime-trace', '-fproc-stat-report', '-frecord-command')
+
+_COMPILER_RE = re.compile(r'^(cc|c\+\+|gcc|g\+\+|clang|clang\+\+)(-[\d.]+)?$')
+
+# process-wide worker state: unreachable workers are skipped for a while
+_dead = {}
+_identities = {}
+_rotation = itertools.count()
+_state_lock = threading.Lock()
+
+
+def split_command(cmd):
+    """
+    Split a compile command into `(source, object, compile_args)`, where `compile_args`
+    are the flags needed to compile the preprocessed source; return None if the command
+    is not a compile command or if it has to be run locally.
+    """
+    if '-c' not in cmd or '-o' not in cmd[:-1]:
+        return None
+    if any(arg.startswith(flag) for arg in cmd[1:] for flag in _LOCAL_FLAGS):
+        return None
+    sources = [arg for arg in cmd[1:]
+               if os.path.splitext(arg)[1].lower() in _SOURCE_SUFFIXES and os.path.isfile(arg)]
+    if len(sources) != 1:
+        return None
+    source, obj = sources[0], cmd[cmd.index('-o') + 1]
+    compile_args = []
+    args = iter(cmd[1:])
+    for arg in args:
+        if arg == '-o' or arg in _PP_FLAGS:
+            next(args, None)
+        elif arg != source and not arg.startswith(_PP_FLAGS):
+            compile_args.append(arg)
+    return source, obj, compile_args
+
+
+def preprocess_command(cmd, obj, output):
+    cmd = ['-E' if arg == '-c' else arg for arg in cmd]
+    cmd[cmd.index(obj)] = output
+    return cmd
+
+
+def check_args(args):
+    """Make sure compile args can be run on a worker, raise ValueError otherwise."""
+    if '-c' not in args:
+        raise ValueError('not a compile command')
+    for arg in args:
+        if not isinstance(arg, str) or not _SAFE_FLAG_RE.match(arg) \
+                or arg.startswith(_UNSAFE_FLAGS):
+            raise ValueError('flag not allowed: {!r}'.format(arg))
+
+
+def _encode(data):
+    return base64.b64encode(zlib.compress(data)).decode('ascii')
+
+
+def _decode(data):
+    return zlib.decompress(base64.b64decode(data))
+
+
+class RemotePool:
+    """
+    Pool of remote build workers (see `WorkerServer`), distcc-style.
+
+    Compile commands are preprocessed locally, and the preprocessed source is then sent to
+    a worker along with the compiler flags; the object file is sent back and linked locally.
+    Workers are only used if their compiler reports the same version and target as the local
+    one; if no worker is available, the command is run locally.
+    """
+
+    retry_interval = 60
+    identity_timeout = 5
+    compile_timeout = 600
+
+    def __init__(self, workers):
+        self.workers = [w if ':' in w else '{}:{}'.format(w, DEFAULT_PORT) for w in workers]
+
+    @classmethod
+    def from_env(cls, workers=None):
+        """Create a pool given a comma-separated list of workers or `IPYBIND_BUILD_WORKERS`."""
+        workers = workers or os.environ.get('IPYBIND_BUILD_WORKERS', '')
+        workers = [w.strip() for w in workers.split(',') if w.strip()]
+        return cls(workers) if workers else None
+
+    def request(self, worker, path, data, timeout):
+        body = zlib.compress(json.dumps(data).encode('utf-8'))
+        request = urllib.request.Request('http://{}{}'.format(worker, path), data=body,
+                                         headers={'Content-Type': 'application/octet-stream'})
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            return json.loads(zlib.decompress(response.read()).decode('utf-8'))
+
+    def call(self, cancel, *args):
+        """Make a request, giving up on waiting for it as soon as the build is cancelled."""
+        if cancel is None:
+            return self.request(*args)
+        result = {}
+
+        def target():
+            try:
+                result['value'] = self.request(*args)
+            except BaseException as e:
+                result['error'] = e
+
+        thread = threading.Thread(target=target, daemon=True)
+        thread.start()
+        while thread.is_alive():
+            cancel.check()
+            thread.join(0.1)
+        cancel.check()
+        if 'error' in result:
+            raise result['error']
+        return result['value']
+
+    def mark_dead(self, worker, error):
+        with _state_lock:
+            if _dead.get(worker, 0) < time.time():
+                distutils.log.warn('warning: build worker {} is not available ({}), it will be '
+                                   'skipped for {}s'.format(worker, error, self.retry_interval))
+            _dead[worker] = time.time() + self.retry_interval
+
+    def available(self, compiler, identity, cancel=None):
+        """Get workers with a matching compiler which are not known to be down, rotated."""
+        start = next(_rotation) % len(self.workers)
+        workers = self.workers[start:] + self.workers[:start]
+        result = []
+        for worker in workers:
+            if _dead.get(worker, 0) > time.time():
+                continue
+            key = worker, compiler
+            if key not in _identities:
+                try:
+                    response = self.call(cancel, worker, '/identity', {'compiler': compiler},
+                                         self.identity_timeout)
+                except (OSError, ValueError) as e:
+                    self.mark_dead(worker, e)
+                    continue
+                _identities[key] = response.get('identity')
+                if _identities[key] != identity:
+                    distutils.log.warn('warning: compiler on build worker {} does not match the '
+                                       'local one ({!r} vs {!r}), not using it'
+                                       .format(worker, _identities[key], identity))
+            if _identities[key] == identity:
+                result.append(worker)
+        return result
+
+    def compile(self, cmd, run, cancel=None):
+        """
+        Try to run the compile command remotely; `run` is used to run the preprocessor.
+        Returns `(returncode, output)`, or None if the command has to be run locally.
+        If `cancel` (a `Cancellation`) is given, waiting for workers stops once it's cancelled.
+        """
+        parts = split_command(cmd)
+        if parts is None:
+            return None
+        source, obj, compile_args = parts
+        try:
+            check_args(compile_args)  # workers would refuse it anyway
+        except ValueError:
+            return None
+        identity = compiler_identity(cmd[0])
+        workers = self.available(os.path.basename(cmd[0]), identity, cancel) if identity else []
+        if not workers:
+            return None
+        suffix = _SOURCE_SUFFIXES[os.path.splitext(source)[1].lower()]
+        with tempfile.TemporaryDirectory() as d:
+            preprocessed = os.path.join(d, 'source' + suffix)
+            returncode, pp_output = run(preprocess_command(cmd, obj, preprocessed))
+            if returncode != 0:
+                return returncode, pp_output
+            with open(preprocessed, 'rb') as f:
+                data = {'compiler': os.path.basename(cmd[0]), 'args': compile_args,
+                        'suffix': suffix, 'source': _encode(f.read())}
+        for worker in workers:
+            distutils.log.info('compiling {} on {}'.format(os.path.basename(source), worker))
+            try:
+                response = self.call(cancel, worker, '/compile', data, self.compile_timeout)
+            except (OSError, ValueError) as e:
+                self.mark_dead(worker, e)
+                continue
+            if 'error' in response:
+                distutils.log.warn('warning: build worker {} refused the job: {}'
+                                   .format(worker, response['error']))
+                continue
+            if response['returncode'] == 0:
+                with open(obj, 'wb') as f:
+                    f.write(_decode(response['object']))
+            return response['returncode'], pp_output + response['output'].encode('utf-8')
+        return None
+
+
+class WorkerHandler(http.server.BaseHTTPRequestHandler):
+    def do_POST(self):
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            if length > self.server.max_request_size:
+                return self.send_error(413)
+            data = json.loads(zlib.decompress(self.rfile.read(length)).decode('utf-8'))
+            if self.path == '/identity':
+                response = {'identity': self.server.identity(data['compiler'])}
+            elif self.path == '/compile':
+                response = self.server.compile(data)
+            else:
+                return self.send_error(404)
+        except (ValueError, KeyError, TypeError, zlib.error) as e:
+            return self.send_error(400, str(e))
+        body = zlib.compress(json.dumps(response).encode('utf-8'))
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+
+class WorkerServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    """
+    Build worker which compiles preprocessed sources sent by `RemotePool` clients.
+
+    There's no authentication, so it should only be reachable from trusted hosts; only
+    compiling (with code generation, warning and debug info flags) is allowed though, and
+    flags that may read, write or run arbitrary files on the worker are refused.
+    """
+
+    daemon_threads = True
+    max_request_size = 256 * 1024 * 1024
+    timeout = 600
+
+    def __init__(self, address, jobs=None, compilers=None, verbose=False):
+        super().__init__(address, WorkerHandler)
+        self.slots = threading.BoundedSemaphore(jobs or os.cpu_count() or 1)
+        self.compilers = set(compilers or ())
+        self.verbose = verbose
+        self.jobs_done = 0
+
+    def check_compiler(self, compiler):
+        if compiler not in self.compilers and not _COMPILER_RE.match(compiler):
+            raise ValueError('compiler not allowed: {!r}'.format(compiler))
+
+    def identity(self, compiler):
+        self.check_compiler(compiler)
+        return compiler_identity(compiler)
+
+    def compile(self, data):
+        compiler, args, suffix = data['compiler'], list(data['args']), data['suffix']
+        try:
+            self.check_compiler(compiler)
+            if suffix not in ('.i', '.ii'):
+                raise ValueError('unsupported source type: {!r}'.format(suffix))
+            check_args(args)
+        except ValueError as e:
+            return {'error': str(e)}
+        with self.slots, tempfile.TemporaryDirectory() as d:
+            source, obj = os.path.join(d, 'source' + suffix), os.path.join(d, 'source.o')
+            with open(source, 'wb') as f:
+                f.write(_decode(data['source']))
+            try:
+                p = subprocess.Popen([compiler] + args + [source, '-o', obj], cwd=d,
+                                     stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+                try:
+                    out, _ = p.communicate(timeout=self.timeout)
+                except subprocess.TimeoutExpired:
+                    p.kill()
+                    p.communicate()
+                    raise
+                returncode, output = p.returncode, out.decode('utf-8', 'replace')
+            except (OSError, subprocess.TimeoutExpired) as e:
+                returncode, output = 1, str(e)
+            response = {'returncode': returncode, 'output': output}
+            if returncode == 0:
+                with open(obj, 'rb') as f:
+                    response['object'] = _encode(f.read())
+        self.jobs_done += 1
+        return response
+
+
+def serve(host='127.0.0.1', port=DEFAULT_PORT, jobs=None, compilers=None, verbose=False):
+    """Run a build worker until interrupted."""
+    server = WorkerServer((host, port), jobs=jobs, compilers=compilers, verbose=verbose)
+    print('build worker listening on {}:{}'.format(*server.server_address[:2]))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
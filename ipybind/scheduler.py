@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+
+import contextlib
+import os
+import re
+import sys
+import tempfile
+import threading
+import time
+
+import distutils.log
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+# options already reported as unsupported on this platform, see _warn_unsupported
+_warned = set()
+
+
+def _warn_unsupported(option):
+    if option not in _warned:
+        _warned.add(option)
+        distutils.log.warn('warning: {} is not supported on this platform'.format(option))
+
+
+def parse_size(size):
+    """Parse memory size like `512M` or `1.5G` into the number of bytes."""
+    if size is None or isinstance(size, int):
+        return size
+    m = re.match(r'^\s*(\d+(?:\.\d*)?)\s*([kmgt]?)i?b?\s*$', str(size), re.IGNORECASE)
+    if not m:
+        raise ValueError('invalid memory size: {!r}'.format(size))
+    return int(float(m.group(1)) * 1024 ** ' kmgt'.index(m.group(2).lower() or ' '))
+
+
+def jobs_dir():
+    """Host-wide directory shared by all users for coordinating concurrent builds."""
+    default = os.path.join(tempfile.gettempdir(), 'ipybind-jobs')
+    return os.environ.get('IPYBIND_JOBS_DIR') or default
+
+
+def _makedirs(path):
+    if not os.path.isdir(path):
+        os.makedirs(path, exist_ok=True)
+        try:
+            os.chmod(path, 0o1777)  # world-writable with a sticky bit, like /tmp
+        except OSError:
+            pass
+
+
+def _open(path, flags=os.O_RDWR):
+    fd = os.open(path, flags | os.O_CREAT, 0o666)
+    try:
+        os.fchmod(fd, 0o666)  # so that other users can lock it too regardless of umask
+    except OSError:
+        pass
+    return fd
+
+
+def _try_lock(fd):
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        return True
+    except OSError:
+        return False
+
+
+class Scheduler:
+    """
+    Limit the number of concurrent compiler processes across all processes on the host.
+
+    Each running compiler process holds an exclusive lock on one of `jobs` slot files;
+    processes waiting for a free slot queue up in FIFO order using ticket files (stale
+    tickets and slots of dead processes are released automatically by the OS). Resource
+    limits on memory and CPU time, as well as a scheduling priority (niceness) can also be
+    applied to each compiler process.
+    """
+
+    poll_interval = 0.1
+
+    def __init__(self, jobs=None, max_memory=None, max_cpu_time=None, nice=None, stream=None):
+        self.jobs = jobs
+        self.max_memory = parse_size(max_memory)
+        self.max_cpu_time = max_cpu_time
+        self.nice = nice
+        self.stream = stream
+
+    @classmethod
+    def from_env(cls, jobs=None, max_memory=None, max_cpu_time=None, nice=None):
+        """Create a scheduler, with `IPYBIND_{JOBS,MAX_MEMORY,MAX_CPU_TIME}` as defaults."""
+        env = os.environ
+        if jobs is None and env.get('IPYBIND_JOBS'):
+            jobs = int(env['IPYBIND_JOBS'])
+        if max_memory is None:
+            max_memory = env.get('IPYBIND_MAX_MEMORY') or None
+        if max_cpu_time is None and env.get('IPYBIND_MAX_CPU_TIME'):
+            max_cpu_time = int(env['IPYBIND_MAX_CPU_TIME'])
+        return cls(jobs=jobs, max_memory=max_memory, max_cpu_time=max_cpu_time, nice=nice)
+
+    def _write(self, msg):
+        stream = self.stream or sys.stdout
+        stream.write(msg + '\n')
+        stream.flush()
+
+    def _queue_position(self, queue, ticket):
+        position = 0
+        for name in sorted(os.listdir(queue)):
+            if name >= ticket:
+                break
+            path = os.path.join(queue, name)
+            try:
+                fd = os.open(path, os.O_RDONLY)
+            except OSError:
+                continue
+            try:
+                if _try_lock(fd):
+                    # nobody is waiting on this ticket anymore
+                    try:
+                        os.unlink(path)
+                    except OSError:
+                        pass
+                else:
+                    position += 1
+            finally:
+                os.close(fd)
+        return position
+
+    @contextlib.contextmanager
+    def slot(self):
+        """Context manager which waits for a free job slot and holds it."""
+        if not self.jobs or fcntl is None:
+            if self.jobs:
+                _warn_unsupported('limiting the number of concurrent jobs (-j)')
+            yield
+            return
+        root = jobs_dir()
+        queue = os.path.join(root, 'queue')
+        _makedirs(root)
+        _makedirs(queue)
+        ticket = '{:020d}-{}-{}'.format(int(time.time() * 1e6), os.getpid(), threading.get_ident())
+        ticket_path = os.path.join(queue, ticket)
+        # the ticket is locked before it's put into the queue, otherwise other processes
+        # could consider it stale and remove it in the meantime
+        tmp_path = os.path.join(root, '.{}.tmp'.format(ticket))
+        ticket_fd = _open(tmp_path)
+        fcntl.flock(ticket_fd, fcntl.LOCK_EX)
+        try:
+            os.rename(tmp_path, ticket_path)
+        except OSError:
+            os.close(ticket_fd)
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+            raise
+        slot_fd = None
+        start, reported = time.time(), None
+        try:
+            while slot_fd is None:
+                position = self._queue_position(queue, ticket)
+                if position == 0:
+                    for i in range(self.jobs):
+                        fd = _open(os.path.join(root, 'slot-{}'.format(i)))
+                        if _try_lock(fd):
+                            slot_fd = fd
+                            break
+                        os.close(fd)
+                if slot_fd is None:
+                    if position != reported:
+                        self._write('waiting for a build slot ({} job(s) allowed), '
+                                    'queue position: {}'.format(self.jobs, position + 1))
+                        reported = position
+                    time.sleep(self.poll_interval)
+        finally:
+            try:
+                os.unlink(ticket_path)
+            except FileNotFoundError:
+                pass
+            os.close(ticket_fd)
+        if reported is not None:
+            self._write('acquired a build slot after waiting for {:.1f}s'
+                        .format(time.time() - start))
+        try:
+            yield
+        finally:
+            os.close(slot_fd)
+
+    def preexec_fn(self):
+        """Function to be called in the child process to apply the resource limits."""
+        limits = self.max_memory is not None or self.max_cpu_time is not None
+        if resource is None and limits:
+            _warn_unsupported('limiting compiler resources (--max-memory, --max-cpu-time)')
+        if resource is None or not (limits or self.nice):
+            return None
+
+        def apply_limits():
+            if self.nice:
+                os.nice(self.nice)
+            if self.max_memory is not None:
+                resource.setrlimit(resource.RLIMIT_AS, (self.max_memory, self.max_memory))
+            if self.max_cpu_time is not None:
+                resource.setrlimit(resource.RLIMIT_CPU, (self.max_cpu_time, self.max_cpu_time))
+        return apply_limits
@@ -2,56 +2,169 @@
 
 import contextlib
 import os
+import shlex
 import subprocess
 import sys
+import threading
 
 import distutils.errors
+import distutils.log
 import distutils.spawn
 
 
 class inject:
+    """A callable wrapper which can be overridden separately in each thread."""
+
     def __init__(self, fn):
-        self.orig = self.fn = fn
-        self.locked = False
+        self.default = fn
+        self.local = threading.local()
+
+    @property
+    def fn(self):
+        return getattr(self.local, 'fn', self.default)
+
+    @property
+    def orig(self):
+        return getattr(self.local, 'orig', self.default)
+
+    @property
+    def locked(self):
+        return getattr(self.local, 'locked', False)
 
     def set(self, fn, lock=None):
         if not self.locked:
-            self.orig = self.fn
-            self.fn = fn
+            self.local.orig = self.fn
+            self.local.fn = fn
             if lock is not None:
-                self.locked = lock
+                self.local.locked = lock
 
-    def reset(self):
+    def reset(self, unlock=False):
+        if unlock:
+            self.local.locked = False
         if not self.locked:
-            self.fn = self.orig
-            self.locked = False
+            self.local.fn = self.orig
+
+    @contextlib.contextmanager
+    def environ(self, env):
+        """Override environment variables for spawned processes (even if locked)."""
+        orig = getattr(self.local, 'env', {})
+        self.local.env = dict(orig, **(env or {}))
+        try:
+            yield
+        finally:
+            self.local.env = orig
 
     def __call__(self, *args, **kwargs):
+        env = getattr(self.local, 'env', None)
+        if env:
+            kwargs['env'] = dict(kwargs.get('env') or os.environ, **env)
         return self.fn(*args, **kwargs)
 
 
+class local_threshold:
+    """Log threshold descriptor; the main thread sets the default for all other threads."""
+
+    def __init__(self, default):
+        self.default = default
+        self.local = threading.local()
+
+    def __get__(self, obj, cls=None):
+        if obj is None:
+            return self
+        return getattr(self.local, 'value', self.default)
+
+    def __set__(self, obj, value):
+        if threading.current_thread() is threading.main_thread():
+            self.default = value
+        self.local.value = value
+
+
+class Cancellation:
+    """Allows terminating processes spawned by a build from another thread."""
+
+    def __init__(self):
+        self.cancelled = False
+        self.processes = set()
+        self.lock = threading.Lock()
+
+    def cancel(self):
+        with self.lock:
+            self.cancelled = True
+            for p in self.processes:
+                try:
+                    p.terminate()
+                except OSError:
+                    pass
+
+    def check(self):
+        if self.cancelled:
+            raise distutils.errors.DistutilsExecError('build cancelled')
+
+    @contextlib.contextmanager
+    def register(self, p):
+        with self.lock:
+            self.processes.add(p)
+            if self.cancelled:
+                p.terminate()
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.processes.discard(p)
+
+
 def patch_spawn():
     distutils.spawn.spawn = inject(distutils.spawn.spawn)
 
 
-def spawn_fn(mode, handler=None, log_commands=False):
-    def spawn(cmd, search_path=True, verbose=False, dry_run=False):
+def patch_log():
+    # make distutils log threshold thread-local, so that builds can be silenced independently
+    log = getattr(distutils.log, '_global_log', None)
+    if isinstance(log, distutils.log.Log) and 'threshold' in log.__dict__:
+        threshold = log.__dict__.pop('threshold')
+        log.__class__ = type('Log', (type(log),), {'threshold': local_threshold(threshold)})
+
+
+def format_command(cmd):
+    """Quote a command for logging (distutils.spawn._nt_quote_args is gone in setuptools)."""
+    if os.name == 'nt':
+        return subprocess.list2cmdline(cmd)
+    return ' '.join(shlex.quote(arg) for arg in cmd)
+
+
+def spawn_fn(mode, handler=None, log_commands=False, scheduler=None, cancel=None, remote=None):
+    def run(cmd, env=None):
+        with scheduler.slot() if scheduler is not None else contextlib.ExitStack():
+            if cancel is not None:
+                cancel.check()
+            p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                 env=env, preexec_fn=scheduler and scheduler.preexec_fn())
+            with cancel.register(p) if cancel is not None else contextlib.ExitStack():
+                out, _ = p.communicate()
+        return p.returncode, out
+
+    def spawn(cmd, search_path=True, verbose=False, dry_run=False, env=None):
         cmd = list(cmd)
         if search_path:
             cmd[0] = distutils.spawn.find_executable(cmd[0]) or cmd[0]
         if dry_run:
             return
         if log_commands:
-            distutils.log.info(' '.join(distutils.spawn._nt_quote_args(list(cmd))))
+            distutils.log.info(format_command(cmd))
         try:
-            p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-            out, _ = p.communicate()
+            result = None
+            if remote is not None:
+                # only compiling is done remotely, with preprocessing run locally
+                result = remote.compile(cmd, lambda cmd: run(cmd, env=env), cancel)
+            returncode, out = result if result is not None else run(cmd, env=env)
+            if cancel is not None:
+                cancel.check()  # output of a terminated process is of no interest
             if out:
-                out = out.decode('utf-8')
+                out = out.decode('utf-8', 'replace')
                 if handler is not None:
                     out = handler(out) or ''
                 if out.strip():
-                    if mode == 'always' or (mode == 'on_error' and p.returncode != 0):
+                    if mode == 'always' or (mode == 'on_error' and returncode != 0):
                         sep = '-' * 80 + '\n'
                         sys.stdout.write(sep)
                         sys.stdout.write(out)
@@ -59,8 +172,10 @@ def spawn_fn(mode, handler=None, log_commands=False):
                             sys.stdout.write('\n')
                         sys.stdout.write(sep)
                         sys.stdout.flush()
-            if p.returncode != 0:
-                raise subprocess.CalledProcessError(p.returncode, cmd)
+            if returncode != 0:
+                raise subprocess.CalledProcessError(returncode, cmd)
+        except distutils.errors.DistutilsExecError:
+            raise
         except OSError as e:
             raise distutils.errors.DistutilsExecError(
                 'command {!r} failed with exit status {}: {}'
@@ -73,14 +188,17 @@ def spawn_fn(mode, handler=None, log_commands=False):
 
 
 @contextlib.contextmanager
-def spawn_capture(mode='on_error', handler=None, log_commands=False, lock=False):
-    func = spawn_fn(mode, handler=handler, log_commands=log_commands)
+def spawn_capture(mode='on_error', handler=None, log_commands=False, lock=False, env=None,
+                  scheduler=None, cancel=None, remote=None):
+    func = spawn_fn(mode, handler=handler, log_commands=log_commands, scheduler=scheduler,
+                    cancel=cancel, remote=remote)
     target = distutils.spawn.spawn
-    if target.locked:
-        yield
-    else:
-        target.set(func, lock=lock)
-        try:
+    with target.environ(env):
+        if target.locked:
             yield
-        finally:
-            target.reset()
+        else:
+            target.set(func, lock=lock)
+            try:
+                yield
+            finally:
+                target.reset(unlock=lock)
@@ -1,7 +1,9 @@
 # -*- coding: utf-8 -*-
 
 import contextlib
+import os
 import sys
+import tempfile
 
 try:
     import fcntl
@@ -9,7 +11,7 @@ except ImportError:
     fcntl = None
 
 from ipybind.common import is_kernel
-from ipybind.ext.wurlitzer import Wurlitzer
+from ipybind.ext.wurlitzer import Wurlitzer, c_stderr_p, c_stdout_p, libc
 
 _fwd = None
 
@@ -31,6 +33,54 @@ class Forwarder(Wurlitzer):
         self._handle_data(data, self._stderr)
 
 
+class CellCapture:
+    """
+    Redirect C-level stdout / stderr into temporary files and write their contents into
+    `sys.stdout` / `sys.stderr` when stopped. Unlike `Forwarder`, there are no pipes and no
+    polling thread, so it's cheap to start and stop around each cell; the downside is that
+    the output is only shown when the cell finishes.
+    """
+
+    def __init__(self, encoding='utf-8'):
+        self.encoding = encoding
+        self.saved = {}
+
+    @property
+    def active(self):
+        return bool(self.saved)
+
+    def flush(self):
+        if libc:
+            libc.fflush(c_stdout_p)
+            libc.fflush(c_stderr_p)
+
+    def start(self):
+        if self.saved:
+            return
+        self.flush()
+        for name in ('stdout', 'stderr'):
+            fd = getattr(sys, '__{}__'.format(name)).fileno()
+            f = tempfile.TemporaryFile()
+            self.saved[name] = fd, os.dup(fd), f
+            os.dup2(f.fileno(), fd)
+
+    def stop(self):
+        if not self.saved:
+            return
+        self.flush()
+        saved, self.saved = self.saved, {}
+        for name, (fd, save_fd, f) in saved.items():
+            os.dup2(save_fd, fd)
+            os.close(save_fd)
+            with f:
+                f.seek(0)
+                data = f.read()
+            if data:
+                stream = getattr(sys, name)
+                stream.write(data.decode(self.encoding, 'replace'))
+                stream.flush()
+
+
 @contextlib.contextmanager
 def forward(handler=None):
     global _fwd
@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+
+import collections
+import json
+import re
+
+# GCC's -ftime-report section, starting with a header and ending with the total line
+GCC_REPORT_RE = re.compile(r'^Time variable\b.*?^\s*TOTAL\s*:.*?$\n?', re.MULTILINE | re.DOTALL)
+
+_GCC_LINE_RE = re.compile(r'^\s*(?P<name>\S.*?)\s*:\s*(?P<usr>[\d.]+)\s*(?:\(\s*\d+%\)\s*)?'
+                          r'(?P<sys>[\d.]+)\s*(?:\(\s*\d+%\)\s*)?(?P<wall>[\d.]+)')
+
+_CLANG_PHASES = ('Frontend', 'Backend', 'Optimizer', 'CodeGenPasses',
+                 'PerformPendingInstantiations')
+
+
+def extract_gcc_reports(log):
+    """Split GCC's -ftime-report sections out of compiler output; return (reports, rest)."""
+    reports = GCC_REPORT_RE.findall(log)
+    return reports, GCC_REPORT_RE.sub('', log)
+
+
+def parse_gcc_report(text):
+    """
+    Parse GCC's -ftime-report output.
+
+    GCC only reports time per compiler pass (e.g. template instantiation, name lookup)
+    and per phase, so there's no breakdown by header or by template.
+    """
+    report = {'compiler': 'gcc', 'total': None, 'phases': [], 'passes': [],
+              'headers': [], 'instantiations': []}
+    for line in text.splitlines():
+        m = _GCC_LINE_RE.match(line)
+        if not m:
+            continue
+        name, wall = m.group('name').lstrip('|').strip(), float(m.group('wall'))
+        if name == 'TOTAL':
+            report['total'] = wall
+        elif name.startswith('phase '):
+            report['phases'].append((name[len('phase '):], wall))
+        else:
+            report['passes'].append((name, wall))
+    return report
+
+
+def parse_clang_trace(data):
+    """
+    Parse clang's -ftime-trace output (Chrome trace event format).
+
+    Header times are inclusive (i.e., include the time to parse the headers they include);
+    instantiation times are aggregated by template.
+    """
+    if isinstance(data, str):
+        data = json.loads(data)
+    report = {'compiler': 'clang', 'total': None, 'phases': [], 'passes': [],
+              'headers': [], 'instantiations': []}
+    headers = collections.Counter()
+    instantiations = collections.Counter()
+    phases = collections.Counter()
+    for event in data.get('traceEvents', []):
+        if event.get('ph') != 'X':
+            continue
+        name, dur = event.get('name', ''), event.get('dur', 0) * 1e-6
+        detail = event.get('args', {}).get('detail', '')
+        if name == 'Source':
+            headers[detail] += dur
+        elif name in ('InstantiateClass', 'InstantiateFunction'):
+            instantiations[detail] += dur
+        elif name in _CLANG_PHASES:
+            phases[name] += dur
+        elif name == 'ExecuteCompiler':
+            report['total'] = (report['total'] or 0) + dur
+        elif name.startswith('Total ') and name[6:] not in _CLANG_PHASES + ('ExecuteCompiler',):
+            report['passes'].append((name[6:], dur))
+    report['phases'] = phases.most_common()
+    report['headers'] = headers.most_common()
+    report['instantiations'] = instantiations.most_common()
+    report['passes'].sort(key=lambda p: p[1], reverse=True)
+    return report
+
+
+def format_report(report, limit=10, width=80):
+    """Format the compile time report as a text table."""
+    lines = []
+
+    def section(title, rows):
+        if not rows:
+            return
+        lines.append(title)
+        for name, t in rows[:limit]:
+            if len(name) > width - 14:
+                name = '...' + name[-(width - 17):]
+            lines.append('  {:<{}} {:>8.2f}s'.format(name, width - 14, t))
+        lines.append('')
+
+    if report['total'] is not None:
+        total = 'total compile time: {:.2f}s ({})'.format(report['total'], report['compiler'])
+        lines.append(total)
+        lines.append('')
+    section('phases:', report['phases'])
+    section('top headers (inclusive):', report['headers'])
+    section('top template instantiations:', report['instantiations'])
+    passes = sorted(report['passes'], key=lambda p: p[1], reverse=True)
+    section('top compiler passes:', passes)
+    if report['compiler'] == 'gcc':
+        lines.append('(per-header and per-template times are only available with clang)')
+    return '\n'.join(lines).rstrip('\n')
@@ -1,19 +1,25 @@
 # -*- coding: utf-8 -*-
 
 # ipybind includes have to be first so distutils.spawn is patched
-from ipybind.common import override_vars, is_win
+from ipybind.common import cache_path, ext_suffix, override_vars, is_win
 from ipybind.spawn import spawn_capture
 
+import concurrent.futures
+import json
 import os
 import pytest
+import subprocess
 import tempfile
 import sys
 import time
 
 import distutils.ccompiler
+import distutils.errors
+import distutils.spawn
 import distutils.sysconfig
 
 from IPython.testing.globalipapp import get_ipython
+from IPython.core.error import UsageError
 from IPython.core.history import HistoryManager
 
 
@@ -40,6 +46,22 @@ def module(code, name='test', header=None):
                  header=header + '\n' if header else '')
 
 
+def write_notebook(path, cells):
+    with open(path, 'w') as f:
+        json.dump({'nbformat': 4, 'nbformat_minor': 2, 'metadata': {}, 'cells': [
+            {'cell_type': 'code', 'source': '%%pybind11' + line + '\n' + cell,
+             'metadata': {}, 'outputs': [], 'execution_count': None}
+            for line, cell in cells
+        ]}, f)
+    return path
+
+
+def run_cli(*args, **kwargs):
+    env = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    return subprocess.check_output([sys.executable, '-m', 'ipybind'] + list(args),
+                                   env=env, **kwargs).decode()
+
+
 def test_pybind11_capture(ip, capsys):
     ip.run_line_magic('pybind11_capture', '')
     out, _ = capsys.readouterr()
@@ -167,3 +189,679 @@ def test_extra_compile_args(ip):
     else:
         flags = '/W4 /O1'
     ip.run_cell_magic('pybind11', '-f -c="{}"'.format(flags), module(''))
+
+
+def test_native(ip):
+    ip.run_cell_magic('pybind11', '-f --native', module("""
+        m.def("dot", &dot);
+    """, header="""#include <pybind11/stl.h>
+        IPYBIND_MULTIVERSION
+        double dot(std::vector<double> x, std::vector<double> y) {
+            double s = 0;
+            for (size_t i = 0; i < x.size(); ++i) s += x[i] * y[i];
+            return s;
+        }
+    """))
+    assert ip.user_ns['dot']([1, 2, 3], [4, 5, 6]) == 32
+
+    magics = ip.magics_manager.registry['Pybind11Magics']
+    parse = magics.pybind11.parser.parse_args
+    assert magics.compute_hash('', parse([])) != magics.compute_hash('', parse(['--native']))
+
+
+def test_normalize(ip):
+    magics = ip.magics_manager.registry['Pybind11Magics']
+    parse = magics.pybind11.parser.parse_args
+    code = module('m.def("f", []() { return 1; });')
+    edited = '// comment\n\n' + module("""
+        m.def("f", [] ()   {
+            return 1;  /* no-op */
+        });
+    """)
+    assert magics.compute_hash(code, parse([])) != magics.compute_hash(edited, parse([]))
+    args = parse(['--normalize'])
+    assert magics.compute_hash(code, args) == magics.compute_hash(edited, args)
+    for other in ('m.def("f", []() { return 2; });', 'm.def("f ", []() { return 1; });'):
+        assert magics.compute_hash(code, args) != magics.compute_hash(module(other), args)
+    for a, b in [('a + +b', 'a++b'), ('#define F (x)', '#define F(x)'), ('x - -1', 'x--1')]:
+        assert magics.compute_hash(a, args) != magics.compute_hash(b, args)
+
+
+def test_concurrent_builds(ip):
+    magics = ip.magics_manager.registry['Pybind11Magics']
+    environ = dict(os.environ)
+    with tempfile.TemporaryDirectory() as root_dir:
+        flags = []
+        for value in (1, 2):
+            inc_dir = os.path.join(root_dir, 'inc{}'.format(value))
+            os.makedirs(inc_dir)
+            with open(os.path.join(inc_dir, 'value.h'), 'w') as f:
+                f.write('inline int value() {{ return {}; }}\n'.format(value))
+            if is_win():
+                env = 'CL', r'/I \"{}\"'.format(inc_dir)
+            else:
+                env = 'CPLUS_INCLUDE_PATH', inc_dir
+            flags.append('-f -m -e {} "{}"'.format(*env))
+        code = module('m.def("value", &value);', header='#include <value.h>')
+
+        with concurrent.futures.ThreadPoolExecutor(2) as pool:
+            results = list(pool.map(lambda f: magics.build(f, code), flags))
+        for value, (args, module_name, libfile) in zip((1, 2), results):
+            magics.import_module(module_name, libfile, import_symbols=False)
+            assert ip.user_ns['test'].value() == value
+    assert dict(os.environ) == environ
+
+
+def test_scheduler(ip, monkeypatch, capsys):
+    from ipybind.scheduler import Scheduler, parse_size
+    assert parse_size('512M') == 512 * 1024 ** 2
+    assert parse_size('1.5g') == int(1.5 * 1024 ** 3)
+
+    with tempfile.TemporaryDirectory() as jobs_dir:
+        monkeypatch.setenv('IPYBIND_JOBS_DIR', jobs_dir)
+        scheduler = Scheduler(jobs=1)
+        active, peak = [], []
+
+        def job(_):
+            with scheduler.slot():
+                active.append(1)
+                peak.append(len(active))
+                time.sleep(0.2)
+                active.pop()
+
+        # stale tickets (whose owner is gone) are removed instead of blocking the queue
+        if not is_win():
+            os.makedirs(os.path.join(jobs_dir, 'queue'))
+            open(os.path.join(jobs_dir, 'queue', '0' * 20), 'w').close()
+
+        with concurrent.futures.ThreadPoolExecutor(3) as pool:
+            list(pool.map(job, range(3)))
+        assert max(peak) == 1
+        if not is_win():
+            assert os.listdir(os.path.join(jobs_dir, 'queue')) == []
+            assert not [name for name in os.listdir(jobs_dir) if name.endswith('.tmp')]
+        out, _ = capsys.readouterr()
+        if not is_win():
+            assert 'queue position: 2' in out
+            assert 'acquired a build slot' in out
+
+        ip.run_cell_magic('pybind11', '-f -j 1', module('m.attr("x") = 1;'))
+        assert ip.user_ns['x'] == 1
+        if not is_win():
+            with pytest.raises(SystemExit):
+                ip.run_cell_magic('pybind11', '-f -j 1 --max-memory 16M', module(''))
+
+    # unsupported options are reported (once) instead of being silently ignored
+    import ipybind.scheduler
+    monkeypatch.setattr(ipybind.scheduler, 'fcntl', None)
+    monkeypatch.setattr(ipybind.scheduler, 'resource', None)
+    monkeypatch.setattr(ipybind.scheduler, '_warned', set())
+    capsys.readouterr()
+    for _ in range(2):
+        scheduler = Scheduler(jobs=2, max_memory='1G')
+        with scheduler.slot():
+            assert scheduler.preexec_fn() is None
+    _, err = capsys.readouterr()
+    assert err.count('(-j) is not supported on this platform') == 1
+    assert err.count('(--max-memory, --max-cpu-time) is not supported') == 1
+
+
+def test_profile_calls(ip, capsys):
+    code = """
+        #include <pybind11/stl.h>
+        void noop() {}
+        PYBIND11_MODULE(test, m) {
+            m.def("add", [](int x, int y) { return x + y; }, py::arg("x"), py::arg("y") = 1);
+            m.def("add", [](const std::string &x, const std::string &y) { return x + y; });
+            m.def("noop", &noop);
+            m.attr("z") = 3;
+        }
+    """
+    ip.run_cell_magic('pybind11', '-f --profile-calls', code)
+    add, noop = ip.user_ns['add'], ip.user_ns['noop']
+    assert '__ipybind_stats__' not in ip.user_ns
+    assert add(1, 2) == 3 and add(2) == 3 and add('a', 'b') == 'ab'
+    for _ in range(5):
+        noop()
+
+    ip.run_line_magic('pybind11_stats', '-s calls -r')
+    out, _ = capsys.readouterr()
+    lines = out.splitlines()
+    assert lines[0].split() == ['function', 'module', 'calls', 'total', 'mean']
+    assert lines[1].split()[:3:2] == ['noop', '5']
+    assert lines[2].split()[:3:2] == ['add', '3']
+    ip.run_line_magic('pybind11_stats', '-n 1')
+    out, _ = capsys.readouterr()
+    assert len(out.splitlines()) == 2 and ' 0 ' in out
+
+    ip.run_cell_magic('pybind11', '-f', code)
+    magics = ip.magics_manager.registry['Pybind11Magics']
+    assert not hasattr(list(magics.modules.values())[-1], '__ipybind_stats__')
+
+
+def test_cli_build(ip):
+    magics = ip.magics_manager.registry['Pybind11Magics']
+    cells = [(' -std=c++14;', module('m.attr("a") = 1;')), ('', module('m.attr("b") = 2;'))]
+    with tempfile.TemporaryDirectory() as root_dir:
+        notebook = write_notebook(os.path.join(root_dir, 'test.ipynb'),
+                                  cells + [(' -f', module(''))])
+        cache = os.path.join(root_dir, 'cache')
+        out = run_cli('build', notebook, '--cache-dir', cache)
+        assert 'test.ipynb[2]: skipped' in out
+        for line, cell in cells:
+            code = magics.format_code(cell)
+            module_name = 'pybind11_' + magics.compute_hash(code, magics.parse_args(line))
+            assert module_name in out
+            assert os.path.isfile(os.path.join(cache, module_name + ext_suffix()))
+
+
+def test_cli_export():
+    with tempfile.TemporaryDirectory() as root_dir:
+        notebook = write_notebook(os.path.join(root_dir, 'test.ipynb'), [
+            ('', module('m.attr("a") = 1;', name='foo')),
+            (' -std=c++14 -c=-DVALUE=42 -I inc', """
+                PYBIND11_MODULE(bar, m) { m.attr("b") = VALUE; }
+            """),
+        ])
+        dist = os.path.join(root_dir, 'dist')
+        out = run_cli('export', notebook, '--name', 'foobar', '--sdist', '-o', dist)
+        sdist = os.path.join(dist, 'foobar-0.1.0.tar.gz')
+        assert out.split() == [sdist]
+        import tarfile
+        with tarfile.open(sdist) as tar:
+            names = tar.getnames()
+            setup_py = tar.extractfile('foobar-0.1.0/setup.py').read().decode()
+            pyproject = tar.extractfile('foobar-0.1.0/pyproject.toml').read().decode()
+        assert 'foobar-0.1.0/foo.cpp' in names and 'foobar-0.1.0/bar.cpp' in names
+        assert 'foobar-0.1.0/include/pybind11_preamble.h' in names
+        assert "'-DVALUE=42'" in setup_py and "'-std=c++14'" in setup_py
+        assert repr(os.path.join(root_dir, 'inc')) in setup_py
+        assert 'ipybind' not in pyproject and 'import ipybind' not in setup_py
+
+        try:
+            import wheel  # noqa: F401
+        except ImportError:
+            return
+        out = run_cli('export', notebook, '-c', '1', '-o', dist)
+        import zipfile
+        with zipfile.ZipFile(out.strip()) as whl:
+            whl.extractall(os.path.join(root_dir, 'whl'))
+        out = subprocess.check_output([sys.executable, '-S', '-c', 'import bar, sys; '
+                                       'print(bar.b, "IPython" in sys.modules)'],
+                                      cwd=os.path.join(root_dir, 'whl')).decode()
+        assert out.split() == ['42', 'False']
+
+
+def test_time_report(ip, capsys):
+    from ipybind.time_report import format_report, parse_clang_trace
+    trace = {'traceEvents': [
+        {'ph': 'X', 'name': 'Source', 'dur': 2e6, 'args': {'detail': '/usr/include/pybind11.h'}},
+        {'ph': 'X', 'name': 'InstantiateFunction', 'dur': 1e6, 'args': {'detail': 'f<int>'}},
+        {'ph': 'X', 'name': 'InstantiateFunction', 'dur': 5e5, 'args': {'detail': 'f<int>'}},
+        {'ph': 'X', 'name': 'Frontend', 'dur': 3e6},
+        {'ph': 'X', 'name': 'ExecuteCompiler', 'dur': 4e6},
+    ]}
+    report = parse_clang_trace(trace)
+    assert report['total'] == 4
+    assert report['headers'] == [('/usr/include/pybind11.h', 2)]
+    assert report['instantiations'] == [('f<int>', 1.5)]
+    assert 'f<int>' in format_report(report)
+
+    if is_win():
+        return
+    ip.run_cell_magic('pybind11', '-f --time-report', module('m.attr("x") = 1;'))
+    out, _ = capsys.readouterr()
+    assert 'total compile time' in out
+    assert 'template instantiation' in out or 'top headers' in out
+    raw = out.split('raw report: ')[1].split('\n')[0]
+    assert os.path.isfile(raw)
+
+
+def test_linker(ip, capsys):
+    if is_win():
+        return
+    ip.run_cell_magic('pybind11', '-f -v --linker default', module('m.attr("x") = 1;'))
+    out, _ = capsys.readouterr()
+    assert '-fuse-ld=' not in out
+    assert ip.user_ns['x'] == 1
+
+    ip.run_cell_magic('pybind11', '-f -v', module('m.attr("x") = 2;'))
+    out, _ = capsys.readouterr()
+    assert ip.user_ns['x'] == 2
+    if 'using linker: ' in out:
+        flag = out.split('using linker: ')[1].split('\n')[0]
+        assert flag in out.split('-shared', 1)[1]
+
+    magics = ip.magics_manager.registry['Pybind11Magics']
+    parse = magics.pybind11.parser.parse_args
+    assert magics.compute_hash('', parse([])) == magics.compute_hash('', parse(['--linker=gold']))
+
+
+def test_size(ip, capsys):
+    if is_win():
+        return
+    magics = ip.magics_manager.registry['Pybind11Magics']
+    libfile = lambda: next(reversed(magics.modules.values())).__file__
+    ip.run_cell_magic('pybind11', '-f', module('m.def("f", []() { return 1; });'))
+    size = os.path.getsize(libfile())
+    ip.run_cell_magic('pybind11', '-f -v --size strip', module('m.def("f", []() { return 2; });'))
+    out, _ = capsys.readouterr()
+    assert ip.user_ns['f']() == 2
+    assert 'binary size: ' in out
+    assert os.path.getsize(libfile()) < size
+
+
+def test_build_temp(ip):
+    magics = ip.magics_manager.registry['Pybind11Magics']
+    with tempfile.TemporaryDirectory() as d:
+        ip.run_cell_magic('pybind11', '-f --build-temp "{}"'.format(d),
+                          module('m.attr("x") = 36;'))
+        assert ip.user_ns['x'] == 36
+        assert os.listdir(d) == []
+    module_name = next(reversed(magics.modules))
+    assert not os.path.exists(os.path.join(os.path.dirname(magics.modules[module_name].__file__),
+                                           module_name))
+
+
+def test_prewarm(ip):
+    from ipybind.build_ext import _flag_cache
+    from ipybind.prewarm import start_prewarm, prewarm
+    thread = start_prewarm()
+    if thread is not None:
+        thread.join()
+    assert any(flags == ('-std=c++14',) or flags == ('/std:c++14',)
+               for _, _, flags, _ in _flag_cache)
+    probes = set(_flag_cache)
+    prewarm()
+    assert set(_flag_cache) == probes
+
+    # start from scratch, since other tests may have run the probes already
+    _flag_cache.clear()
+    prewarm()
+    probes = set(_flag_cache)
+    assert probes
+
+    # a default build reuses the probes run by prewarming instead of running its own
+    ip.run_cell_magic('pybind11', '-f', module('m.attr("x") = 48;'))
+    assert ip.user_ns['x'] == 48
+    assert set(_flag_cache) == probes
+
+
+def test_syntax_check(ip, capsys, tmpdir):
+    from ipybind.common import default_compiler
+    from ipybind.spawn import Cancellation
+    cancel = Cancellation()
+    cancel.cancel()
+    with spawn_capture(cancel=cancel):
+        with pytest.raises(distutils.errors.DistutilsExecError):
+            distutils.spawn.spawn([sys.executable, '-c', 'pass'])
+
+    if not is_win():
+        # the actual compile of the cell hangs, so the build only fails if it's cancelled
+        compiler = str(tmpdir.join('cc'))
+        with open(compiler, 'w') as f:
+            f.write('#!/bin/sh\ncase "$*" in\n    *-fsyntax-only*) ;;\n'
+                    '    *pybind11_*.cpp*) exec sleep 300 ;;\nesac\n'
+                    'exec {} "$@"\n'.format(default_compiler()))
+        os.chmod(compiler, 0o755)
+        start = time.time()
+        with pytest.raises(SystemExit) as excinfo:
+            ip.run_cell_magic('pybind11', '-f --no-pch --syntax-check -e CC ' + compiler,
+                              module('m.attr("x") = 1', name='bad'))
+        assert str(excinfo.value) == 'error: syntax check failed'
+        assert time.time() - start < 120
+        out, _ = capsys.readouterr()
+        assert '<source>' in out and 'error' in out
+
+    ip.run_cell_magic('pybind11', '-f --syntax-check', module('m.attr("x") = 38;'))
+    assert ip.user_ns['x'] == 38
+
+
+def test_memo(ip, monkeypatch):
+    magics = ip.magics_manager.registry['Pybind11Magics']
+    code = module('m.def("f", []() { return 39; });') + '// ' + str(time.time())
+    ip.run_cell_magic('pybind11', '', code)
+    f = ip.user_ns.pop('f')
+
+    # unchanged cells are imported from memory without rebuilding or even hashing
+    monkeypatch.setattr(magics, 'build', None)
+    ip.run_cell_magic('pybind11', '', code)
+    assert ip.user_ns['f'] is f
+    monkeypatch.undo()
+
+    # force-rebuilt cells are never memoized
+    ip.run_cell_magic('pybind11', '-f', code)
+    assert ('-f', code) not in magics.memo
+    assert ip.user_ns['f'] is not f
+
+
+def test_bundle(ip, capsys):
+    magics = ip.magics_manager.registry['Pybind11Magics']
+    bundle = 'b' + str(int(time.time() * 1e6))
+    cells = [
+        (' --bundle ' + bundle, 'static int f() { return 1; }\n'
+                                'PYBIND11_MODULE(one, m) { m.def("f", &f); }'),
+        (' --bundle {} -m'.format(bundle), 'static int f() { return 2; }\n'
+                                           'PYBIND11_MODULE(two, m) { m.def("f", &f); }'),
+        (' --bundle ' + bundle, module('m.def("g", []() { return 3; });', name='three')),
+    ]
+    for line, cell in cells:
+        ip.run_cell_magic('pybind11', line, cell)
+    out, _ = capsys.readouterr()
+    assert 'bundle ' + bundle in out
+    assert 'f' not in ip.user_ns or ip.user_ns['f']() != 1
+
+    ip.run_line_magic('pybind11_bundle', bundle + ' --profile-calls')
+    assert ip.user_ns['f']() == 1
+    assert ip.user_ns['two'].f() == 2
+    assert ip.user_ns['g']() == 3
+    mod = next(reversed(magics.modules.values()))
+    assert ip.user_ns['two'] is mod.two
+    assert mod.__ipybind_stats__()['f']['calls'] == 2
+
+    # re-running an unchanged cell imports it from the built bundle
+    del ip.user_ns['g']
+    ip.run_cell_magic('pybind11', *cells[2])
+    assert ip.user_ns['g']() == 3
+
+    with pytest.raises(UsageError):
+        ip.run_cell_magic('pybind11', '--bundle {} -std=c++14'.format(bundle), cells[0][1])
+    with pytest.raises(UsageError):
+        ip.run_line_magic('pybind11_bundle', 'empty')
+
+    with tempfile.TemporaryDirectory() as root_dir:
+        notebook = write_notebook(os.path.join(root_dir, 'test.ipynb'), cells[:2])
+        with open(notebook) as f:
+            nb = json.load(f)
+        nb['cells'].append({'cell_type': 'code', 'source': '%pybind11_bundle ' + bundle,
+                            'metadata': {}, 'outputs': [], 'execution_count': None})
+        with open(notebook, 'w') as f:
+            json.dump(nb, f)
+        cache = os.path.join(root_dir, 'cache')
+        out = run_cli('build', notebook, '--cache-dir', cache)
+        assert 'building 1 cell(s)' in out
+        module_name = out.split('test.ipynb[2]: ')[1].split()[0]
+        assert os.path.isfile(os.path.join(cache, module_name + ext_suffix()))
+
+
+def test_autotune(ip, capsys):
+    magics = ip.magics_manager.registry['Pybind11Magics']
+    cell = module('m.def("f", []() { return 41; });') + '// ' + str(time.time())
+    ip.run_cell_magic('pybind11_autotune', '-b "f()" --config= --config=--no-lto --pin', cell)
+    out, _ = capsys.readouterr()
+    assert 'rank' in out and '(default)' in out and '--no-lto' in out
+    assert ip.user_ns['f']() == 41
+    pinned = magics.load_pins()[magics.pin_key(cell)]
+    assert pinned in ('', '--no-lto')
+
+    # pinned options are used by default
+    _, module_name, _ = magics.build('', cell)
+    code = magics.format_code(cell)
+    assert module_name == 'pybind11_' + magics.compute_hash(code, magics.parse_args(pinned))
+
+    # explicit options take precedence over the pinned ones
+    args = magics.parse_args('-c=-O1 --no-native --lto -e CXX g++',
+                             '--native --no-lto -c=-O2 -e CC clang')
+    assert not args.native and args.lto and args.extra_compile_args == ['-O1']
+    assert args.env == [['CC', 'clang'], ['CXX', 'g++']]
+    assert magics.parse_args('', '--native -c=-O2') == magics.parse_args('--native -c=-O2')
+
+    ip.run_cell_magic('pybind11_autotune', '-b "f()" --unpin', cell)
+    assert magics.pin_key(cell) not in magics.load_pins()
+
+
+def test_remote(ip, capsys):
+    if is_win():
+        return
+    import threading
+    import socket
+    from ipybind.remote import RemotePool, WorkerServer, check_args, split_command
+    from ipybind.spawn import Cancellation
+    assert split_command(['g++', '-c', 'x.o']) is None
+    check_args(['-c', '-O3', '-fPIC', '-std=c++17', '-Wlogical-op', '-march=x86-64', '-g'])
+    for args in (['-O3'], ['-c', '-Xclang', '-load'], ['-c', '-fpass-plugin=x.so'],
+                 ['-c', '-fuse-ld=/tmp/ld'], ['-c', '-Wl,-rpath'], ['-c', '-B/tmp'],
+                 ['-c', '-fsanitize-ignorelist=/etc/passwd'], ['-c', '@args']):
+        with pytest.raises(ValueError):
+            check_args(args)
+
+    # waiting on a worker stops as soon as the build is cancelled
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        s.listen(1)
+        cancel = Cancellation()
+        threading.Timer(0.2, cancel.cancel).start()
+        with pytest.raises(distutils.errors.DistutilsExecError):
+            RemotePool([]).call(cancel, '127.0.0.1:{}'.format(s.getsockname()[1]),
+                                '/identity', {}, 60)
+
+    server = WorkerServer(('127.0.0.1', 0), jobs=1)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        worker = '127.0.0.1:{}'.format(server.server_address[1])
+        ip.run_cell_magic('pybind11', '-f -v --remote ' + worker, module('m.attr("x") = 42;'))
+        out, _ = capsys.readouterr()
+        assert '.cpp on ' + worker in out
+        assert server.jobs_done == 1
+        assert ip.user_ns['x'] == 42
+
+        # compile errors are reported as usual
+        with pytest.raises(SystemExit):
+            ip.run_cell_magic('pybind11', '-f --remote ' + worker, module('m.attr("x") = 1'))
+        out, _ = capsys.readouterr()
+        assert 'error' in out
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    # unreachable workers are skipped
+    ip.run_cell_magic('pybind11', '-f --remote ' + worker, module('m.attr("x") = 43;'))
+    assert ip.user_ns['x'] == 43
+    _, err = capsys.readouterr()
+    assert 'build worker {} is not available'.format(worker) in err
+
+
+def test_cache_key(ip, monkeypatch):
+    magics = ip.magics_manager.registry['Pybind11Magics']
+    parse = magics.pybind11.parser.parse_args
+    cell = module('m.attr("x") = 44;')
+    code = magics.format_code(cell)
+    interpreter = magics.compute_hash(code, parse([]))
+    abi = magics.compute_hash(code, parse(['--cache-key', 'abi']))
+    assert interpreter != abi
+    assert magics.compute_hash(code, parse(['--cache-key', 'interpreter'])) == interpreter
+
+    # environments sharing the same Python build share the binaries
+    monkeypatch.setattr(sys, 'executable', '/some/other/venv/bin/python')
+    assert magics.compute_hash(code, parse([])) != interpreter
+    assert magics.compute_hash(code, parse(['--cache-key', 'abi'])) == abi
+    monkeypatch.setenv('IPYBIND_CACHE_KEY', 'abi')
+    assert magics.compute_hash(code, parse([])) == abi
+    assert magics.compute_hash(code, parse(['-e', 'CC', 'clang'])) != abi
+    monkeypatch.setenv('IPYBIND_CACHE_KEY', 'foo')
+    with pytest.raises(UsageError):
+        magics.compute_hash(code, parse([]))
+    monkeypatch.undo()
+
+    # headers from user include directories are hashed too
+    with tempfile.TemporaryDirectory() as d:
+        with open(os.path.join(d, 'answer.h'), 'w') as f:
+            f.write('#define ANSWER 42\n')
+        header = magics.format_code('#include <answer.h>\n' + cell)
+        before = magics.compute_hash(header, parse(['--cache-key', 'abi', '-I', d]))
+        assert magics.compute_hash(header, parse(['--cache-key', 'abi', '-I', d])) == before
+        time.sleep(0.01)
+        with open(os.path.join(d, 'answer.h'), 'w') as f:
+            f.write('#define ANSWER 43\n')
+        assert magics.compute_hash(header, parse(['--cache-key', 'abi', '-I', d])) != before
+
+        # cells already run in this session are rebuilt if any included header changes
+        answer = module('m.attr("answer") = ANSWER;', header='#include <answer.h>')
+        line = '--cache-key abi -I ' + d
+        ip.run_cell_magic('pybind11', line, answer)
+        assert ip.user_ns['answer'] == 43
+        ip.run_cell_magic('pybind11', line, answer)
+        assert ip.user_ns['answer'] == 43
+        assert magics.memo[(line, answer)][2]
+        time.sleep(0.01)
+        with open(os.path.join(d, 'answer.h'), 'w') as f:
+            f.write('#define ANSWER 44\n')
+        ip.run_cell_magic('pybind11', line, answer)
+        assert ip.user_ns['answer'] == 44
+        magics.memo.pop((line, answer))  # the include directory is about to be removed
+
+    ip.run_cell_magic('pybind11', '--cache-key abi', cell)
+    assert ip.user_ns['x'] == 44
+    assert next(reversed(magics.modules)) == 'pybind11_' + abi
+
+
+def test_capture_auto(ip, capsys, monkeypatch):
+    if is_win():
+        return
+    import ipybind.magic
+    monkeypatch.setattr(ipybind.magic, 'is_kernel', lambda: True)
+    magics = ip.magics_manager.registry['Pybind11Magics']
+    ip.run_cell_magic('pybind11', '', module("""
+        m.def("say", [](int x) { std::printf("native %d\\n", x); std::fflush(stdout); });
+    """, header='#include <cstdio>'))
+    ip.run_line_magic('pybind11_capture', 'auto')
+    try:
+        assert magics.calls_native('say(1)')
+        assert not magics.calls_native('print(1)')
+        ip.run_cell('def wrapper(x):\n    say(x)')
+        assert magics.calls_native('wrapper(1)')
+
+        capsys.readouterr()
+        ip.run_cell('wrapper(45)')
+        out, _ = capsys.readouterr()
+        assert 'native 45' in out
+        assert not magics.cell_capture.active
+    finally:
+        ip.run_line_magic('pybind11_capture', 'off')
+    assert not magics.capture_hooks
+
+
+def test_pch(ip, capsys):
+    from ipybind.normalize import leading_includes
+    code = '// x\n#include <a.h>  // y\n\n# include "b.h"\nint x;\n#include <c>'
+    assert leading_includes(code) == ['#include <a.h>', '#include "b.h"']
+    assert leading_includes('int x;\n#include <a.h>') == []
+    if is_win():
+        return
+    header = '#include <pybind11/stl.h>\n#include <vector>'
+    for i in range(3):
+        ip.run_cell_magic('pybind11', '-f -v', module("""
+            m.def("f", [](std::vector<int> v) {{ return v.size() + {}; }});
+        """.format(i), header=header))
+        assert ip.user_ns['f']([1, 2]) == 2 + i
+    out, _ = capsys.readouterr()
+    last = out.split('running build_ext')[-1]
+    assert '-include ' in last and '-Winvalid-pch' in last
+    path = last.split('-include ')[1].split()[0]
+    assert os.path.isfile(path + '.gch')
+    assert 'not used because' not in last
+
+    ip.run_cell_magic('pybind11', '-f -v --no-pch', module('m.attr("x") = 46;', header=header))
+    out, _ = capsys.readouterr()
+    assert '-include ' not in out
+
+
+def test_diagnostics(ip, capsys):
+    from ipybind.diagnostics import parse_diagnostics, summarize
+    steps = ''.join('a.h:{0}:1:   required from \'f<{0}>\'\n'.format(i) for i in range(10))
+    log = ("a.h: In instantiation of 'f<10>':\n" + steps + "x.cpp:3:1:   required from here\n"
+           "a.h:1:5: error: oops\n    1 | int x = T::y;\n      |     ^\nx.cpp: In function:\n"
+           "x.cpp:5:2: warning: unused\nx.cpp:6:2: error: again\nx.cpp:6:2: note: see this\n")
+    diags = parse_diagnostics(log)
+    assert [(d.severity, d.line, d.message) for d in diags] == [
+        ('error', 1, 'oops'), ('warning', 5, 'unused'), ('error', 6, 'again')]
+    assert diags[1].lines == ['x.cpp: In function:', 'x.cpp:5:2: warning: unused']
+    summary, omitted = summarize(log, max_errors=1)
+    assert omitted
+    assert '[... 8 more instantiation steps ...]' in summary
+    assert "f<1>" in summary and 'required from here' in summary and "f<5>" not in summary
+    assert 'unused' in summary and 'again' not in summary
+    assert '[... 1 more error not shown ...]' in summary
+    assert summarize('x.cpp:5:2: warning: unused\n') == ('x.cpp:5:2: warning: unused\n', False)
+
+    code = module('m.attr("x") = a;\n        m.attr("y") = b;\n        m.attr("z") = c;')
+    with pytest.raises(SystemExit):
+        ip.run_cell_magic('pybind11', '-f --max-errors 1', code)
+    out, _ = capsys.readouterr()
+    assert out.count('was not declared') == 1
+    assert 'more errors not shown' in out
+    path = out.split('[full log: ')[1].split(']')[0]
+    with open(path) as f:
+        assert f.read().count('was not declared') == 3
+
+
+def test_snapshot(ip, capsys, tmpdir):
+    from ipybind.magic import Pybind11Magics
+    stamp = '// ' + str(time.time())
+    cells = [('', module('m.attr("x") = 45;', name='snap_a') + stamp),
+             ('-m', module('m.attr("y") = 46;', name='snap_b') + stamp)]
+    for line, cell in cells:
+        ip.run_cell_magic('pybind11', line, cell)
+    path = str(tmpdir.join('snapshot.json'))
+    ip.run_line_magic('pybind11_snapshot', path)
+    assert 'Saved' in capsys.readouterr()[0]
+    with open(path) as f:
+        snapshot = json.load(f)
+    saved = snapshot['cells'][-2:]
+    assert [(c['line'], c['cell']) for c in saved] == cells
+    os.remove(cache_path(saved[0]['module'] + ext_suffix()))
+
+    # recorded module names are not trusted, e.g. the cache may be shared by environments
+    modules = [c['module'] for c in saved]
+    snapshot['cells'][-1]['module'] = modules[0]
+    with open(path, 'w') as f:
+        json.dump(snapshot, f)
+
+    # a fresh session restores everything at once, rebuilding evicted modules
+    ip.user_ns.pop('x')
+    ip.user_ns.pop('snap_b')
+    restored = Pybind11Magics(shell=ip)
+    restored.pybind11_restore(path)
+    out, _ = capsys.readouterr()
+    assert '(1 rebuilt)' in out and 'failed' not in out
+    assert ip.user_ns['x'] == 45 and ip.user_ns['snap_b'].y == 46
+    assert [restored.memo[cell][0] for cell in cells] == modules
+    with pytest.raises(UsageError):
+        restored.pybind11_restore(str(tmpdir.join('missing.json')))
+
+    # the default snapshot file is per notebook
+    with pytest.raises(UsageError):
+        restored.pybind11_snapshot('')
+    ip.user_ns['__session__'] = '/some/dir/analysis.ipynb'
+    restored.pybind11_snapshot('')
+    out, _ = capsys.readouterr()
+    assert os.path.join(cache_path('snapshots'), 'analysis-') in out
+
+
+def test_explain(ip, capsys):
+    magics = ip.magics_manager.registry['Pybind11Magics']
+    cell = module('m.attr("x") = 47;') + '// ' + str(time.time())
+    ip.run_cell_magic('pybind11', '-std=c++14', cell)
+    ip.user_ns.pop('x')
+    capsys.readouterr()
+
+    ip.run_cell_magic('pybind11', '-std=c++14 --explain', cell)
+    assert capsys.readouterr()[0].startswith('Cache hit: pybind11_')
+    assert 'x' not in ip.user_ns
+    ip.run_cell_magic('pybind11', '-f -std=c++14 --explain', cell)
+    out, _ = capsys.readouterr()
+    assert 'Cache hit: pybind11_' in out and 'timestamp' not in out
+
+    # the nearest cached entry is the one built above, differing in a single input
+    magics.build_module = None
+    try:
+        ip.run_cell_magic('pybind11', '-std=c++17 --explain', cell)
+        out, _ = capsys.readouterr()
+        assert 'Cache miss' in out and '(1 difference)' in out
+        assert '  std: "c++14" -> "c++17"' in out
+        ip.run_cell_magic('pybind11', '-std=c++14 --explain', cell.replace('47', '48'))
+        out, _ = capsys.readouterr()
+        assert '  code:' in out and '-        m.attr("x") = 47;' in out
+        assert '+        m.attr("x") = 48;' in out
+    finally:
+        del magics.build_module